@@ -0,0 +1,441 @@
+#!/usr/bin/env python
+"""Local stand-in for a GeoNode and its GeoServer, to benchmark the extractor
+   without touching a live site.
+
+   It serves the parts of the API that geonode-extract uses:
+
+    * /data/search/api, the search API, with rows, total and next, that
+      can be filtered by type, vector or raster, and bbox
+    * /download/<name>.zip and /download/<name>.tiff, the data of each layer,
+      with a content-disposition header, byte ranges and ETags
+    * /catalogue/csw, GetRecordById and GetRecords for the ISO metadata
+    * /geoserver/styles/<name>.sld, the style of each layer
+
+   Every response can be delayed and throttled to imitate a remote server,
+   and the server can be made to push back with 429 and 503 responses.
+   /_stats returns the number of requests and bytes served so far as JSON,
+   /_stats?reset=1 also sets them back to zero.
+
+   Usage: python benchmarks/fake_geonode.py --layers 1000 --port 8000
+"""
+from __future__ import with_statement
+
+import re
+import random
+import sys
+import json
+import time
+import socket
+import datetime
+import urllib
+import zipfile
+import hashlib
+import urlparse
+import threading
+import cStringIO
+import SocketServer
+import BaseHTTPServer
+from optparse import OptionParser
+
+
+def add_server_options(parser):
+    """Adds the options of the server to parser, the benchmark harness
+       shares them.
+    """
+    parser.add_option("--host", dest="host", default="127.0.0.1",
+                      help="Address to listen on (default 127.0.0.1)")
+    parser.add_option("--port", dest="port", type="int", default=8000,
+                      help="Port to listen on, 0 picks a free one (default 8000)")
+    parser.add_option("--layers", dest="layers", type="int", default=100,
+                      help="Number of layers in the catalog (default 100)")
+    parser.add_option("--page-size", dest="page_size", type="int", default=50,
+                      help="Layers per page of the search API (default 50)")
+    parser.add_option("--zip-size", dest="zip_size", type="int", default=256 * 1024,
+                      help="Size in bytes of the zipped shapefile of vector layers (default 256 KB)")
+    parser.add_option("--tiff-size", dest="tiff_size", type="int", default=1024 * 1024,
+                      help="Size in bytes of the GeoTIFF of raster layers (default 1 MB)")
+    parser.add_option("--raster-ratio", dest="raster_ratio", type="float", default=0.25,
+                      help="Fraction of the layers that are rasters (default 0.25)")
+    parser.add_option("--latency", dest="latency", type="float", default=0.0,
+                      help="Seconds to wait before answering every request (default 0)")
+    parser.add_option("--bandwidth", dest="bandwidth", type="int", default=0,
+                      help="Bytes per second sent on each connection, 0 for no limit (default 0)")
+    parser.add_option("--fail", dest="fail", action="append", default=[],
+                      help="Name of a layer whose download fails, may be given multiple times")
+    parser.add_option("--csw-page-size", dest="csw_page_size", type="int", default=100,
+                      help="Records per GetRecords response (default 100)")
+    parser.add_option("--distinct", dest="distinct", type="int", default=0,
+                      help="Number of distinct files and styles, shared by all the layers, 0 for "
+                           "every layer having its own (default 0)")
+    parser.add_option("--capacity", dest="capacity", type="int", default=0,
+                      help="Answer 503 with a Retry-After to requests beyond this many at the same "
+                           "time, 0 for no limit (default 0)")
+    parser.add_option("--busy-ratio", dest="busy_ratio", type="float", default=0.0,
+                      help="Fraction of the downloads answered with 429 and a Retry-After (default 0)")
+
+
+parser = OptionParser(usage="%prog [options]")
+add_server_options(parser)
+
+CHUNK_SIZE = 64 * 1024
+
+SHAPEFILE_EXTENSIONS = ['.shp', '.shx', '.dbf', '.prj']
+
+CSW_NAMESPACES = ('xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" '
+                  'xmlns:gmd="http://www.isotc211.org/2005/gmd" '
+                  'xmlns:gco="http://www.isotc211.org/2005/gco"')
+
+RECORD = ('<gmd:MD_Metadata>'
+          '<gmd:fileIdentifier><gco:CharacterString>%(id)s</gco:CharacterString></gmd:fileIdentifier>'
+          '<gmd:identificationInfo><gmd:MD_DataIdentification><gmd:citation><gmd:CI_Citation>'
+          '<gmd:title><gco:CharacterString>%(title)s</gco:CharacterString></gmd:title>'
+          '</gmd:CI_Citation></gmd:citation></gmd:MD_DataIdentification></gmd:identificationInfo>'
+          '</gmd:MD_Metadata>')
+
+STYLE = ('<?xml version="1.0" encoding="UTF-8"?>'
+         '<sld:StyledLayerDescriptor xmlns:sld="http://www.opengis.net/sld" version="1.0.0">'
+         '<sld:NamedLayer><sld:Name>%(name)s</sld:Name><sld:UserStyle><sld:FeatureTypeStyle>'
+         '<sld:Rule><sld:PolygonSymbolizer/></sld:Rule>'
+         '</sld:FeatureTypeStyle></sld:UserStyle></sld:NamedLayer></sld:StyledLayerDescriptor>')
+
+
+class Catalog(object):
+    """The layers served, and their contents, generated from the options.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.zips = {}
+        self.in_flight = 0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {'requests': 0, 'bytes': 0, 'not_modified': 0, 'partial': 0,
+                          'busy': 0, 'peak_concurrency': 0}
+
+    def enter(self):
+        """Counts a request in progress, returns False if there are too many.
+        """
+        with self.lock:
+            self.in_flight += 1
+            self.stats['peak_concurrency'] = max(self.stats['peak_concurrency'],
+                                                 self.in_flight)
+            capacity = self.options.capacity
+            return not capacity or self.in_flight <= capacity
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def name(self, i):
+        return 'layer_%06d' % i
+
+    def index(self, name):
+        match = re.match(r'^layer_(\d+)$', name)
+        if match is None or int(match.group(1)) >= self.options.layers:
+            return None
+        return int(match.group(1))
+
+    def is_raster(self, i):
+        # Spread the rasters evenly over the catalog
+        ratio = self.options.raster_ratio
+        return int((i + 1) * ratio) != int(i * ratio)
+
+    def bbox(self, i):
+        # Layers tile the world in 10 degree squares
+        minx = (i % 36) * 10 - 180
+        miny = (i // 36 % 18) * 10 - 90
+        return [minx, miny, minx + 10, miny + 10]
+
+    def matches(self, i, query):
+        layer_type = query.get('type')
+        if layer_type in ('vector', 'raster') and self.is_raster(i) != (layer_type == 'raster'):
+            return False
+        if query.get('bbox'):
+            x0, y0, x1, y1 = [float(v) for v in query['bbox'].split(',')]
+            minx, miny, maxx, maxy = self.bbox(i)
+            if minx > x1 or x0 > maxx or miny > y1 or y0 > maxy:
+                return False
+        return True
+
+    def row(self, base, i):
+        name = self.name(i)
+        if self.is_raster(i):
+            link = ['tiff', 'GeoTIFF', '%s/download/%s.tiff' % (base, name)]
+        else:
+            link = ['zip', 'Zipped Shapefile', '%s/download/%s.zip' % (base, name)]
+        csw = ('%s/catalogue/csw?outputschema=http%%3A%%2F%%2Fwww.isotc211.org%%2F2005%%2Fgmd'
+               '&service=CSW&request=GetRecordById&version=2.0.2&elementsetname=full&id=%s'
+               % (base, name))
+        minx, miny, maxx, maxy = self.bbox(i)
+        modified = datetime.datetime(2013, 1, 1) + datetime.timedelta(days=i % 1000)
+        return {'name': 'geonode:' + name,
+                'title': 'Layer %d' % i,
+                'storeType': ['dataStore', 'coverageStore'][self.is_raster(i)],
+                'bbox': {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy},
+                'last_modified': modified.isoformat(),
+                'download_links': [link],
+                'metadata_links': [['text/xml', 'TC211', csw]]}
+
+    def seed(self, name):
+        """What the contents of the files of a layer are generated from.
+        """
+        if not self.options.distinct:
+            return name
+        return 'content_%06d' % (self.index(name) % self.options.distinct)
+
+    def zip_body(self, name):
+        """A zipped shapefile of about --zip-size bytes, kept once built.
+        """
+        with self.lock:
+            if name in self.zips:
+                return self.zips[name]
+        member_size = max(self.options.zip_size // len(SHAPEFILE_EXTENSIONS) - 100, 0)
+        out = cStringIO.StringIO()
+        archive = zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED)
+        for extension in SHAPEFILE_EXTENSIONS:
+            archive.writestr(name + extension,
+                             pattern(self.seed(name) + extension, 0, member_size))
+        archive.close()
+        body = out.getvalue()
+        with self.lock:
+            # Only a few are kept around, the catalog may be much larger
+            if len(self.zips) > 64:
+                self.zips.clear()
+            self.zips[name] = body
+        return body
+
+
+def pattern(seed, start, end):
+    """Bytes start to end of an endless repetition of seed, used as the
+       contents of generated files.
+    """
+    seed = seed + '\n'
+    offset = start % len(seed)
+    count = (end - start + offset) // len(seed) + 1
+    return (seed * count)[offset:offset + end - start]
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def catalog(self):
+        return self.server.catalog
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self.path.startswith('/_stats'):
+            # Not counted as part of the load
+            stats = dict(self.catalog.stats)
+            if 'reset' in self.path:
+                self.catalog.reset()
+            return self.send_body(json.dumps(stats), 'application/json')
+
+        self.catalog.count('requests')
+        available = self.catalog.enter()
+        try:
+            if not available:
+                return self.send_busy(503)
+            self.respond()
+        finally:
+            self.catalog.leave()
+
+    def send_busy(self, code):
+        self.catalog.count('busy')
+        self.send_response(code)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def respond(self):
+        if self.catalog.options.latency:
+            time.sleep(self.catalog.options.latency)
+
+        url = urlparse.urlparse(self.path)
+        query = dict((k.lower(), v) for k, v in urlparse.parse_qsl(url.query))
+        base = 'http://%s' % self.headers.get('host', '%s:%s' % self.server.server_address)
+
+        if url.path == '/data/search/api':
+            return self.search(base, query)
+        if url.path.startswith('/download/'):
+            return self.download(url.path.split('/')[-1])
+        if url.path == '/catalogue/csw':
+            if query.get('request') == 'GetRecords':
+                return self.get_records(query)
+            return self.get_record_by_id(query)
+        if url.path.startswith('/geoserver/styles/') and url.path.endswith('.sld'):
+            name = url.path.split('/')[-1][:-len('.sld')]
+            if self.catalog.index(name) is None:
+                return self.send_error(404)
+            return self.send_body(STYLE % {'name': self.catalog.seed(name)},
+                                  'application/vnd.ogc.sld+xml')
+        self.send_error(404)
+
+    def search(self, base, query):
+        options = self.catalog.options
+        matching = [i for i in range(options.layers) if self.catalog.matches(i, query)]
+        start = int(query.get('start', 0))
+        end = min(start + options.page_size, len(matching))
+        data = {'success': True,
+                'total': len(matching),
+                'rows': [self.catalog.row(base, i) for i in matching[start:end]],
+                'next': None}
+        if end < len(matching):
+            params = dict((k, v) for k, v in query.items() if k in ('q', 'type', 'bbox'))
+            params['start'] = end
+            data['next'] = '%s/data/search/api?%s' % (base, urllib.urlencode(params))
+        self.send_body(json.dumps(data), 'application/json')
+
+    def download(self, filename):
+        name, _, extension = filename.rpartition('.')
+        i = self.catalog.index(name)
+        if i is None or extension != ['zip', 'tiff'][self.catalog.is_raster(i)]:
+            return self.send_error(404)
+        if name in self.catalog.options.fail:
+            return self.send_body('Internal error', 'text/plain', code=500)
+        if random.random() < self.catalog.options.busy_ratio:
+            return self.send_busy(429)
+
+        headers = {'Content-Disposition': 'attachment; filename=%s' % filename}
+        if extension == 'zip':
+            body = self.catalog.zip_body(name)
+            self.send_body(body, 'application/zip', headers, ranges=True)
+        else:
+            size = self.catalog.options.tiff_size
+            seed = self.catalog.seed(name)
+            etag = '"%s"' % hashlib.md5('%s-%d' % (seed, size)).hexdigest()
+            self.send_generated(lambda start, end: pattern(seed, start, end), size,
+                                'image/tiff', headers, etag)
+
+    def get_record_by_id(self, query):
+        name = query.get('id', '')
+        if self.catalog.index(name) is None:
+            return self.send_error(404)
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<csw:GetRecordByIdResponse %s>\n  %s\n</csw:GetRecordByIdResponse>'
+                % (CSW_NAMESPACES, RECORD % {'id': name, 'title': name}))
+        self.send_body(body, 'application/xml')
+
+    def get_records(self, query):
+        ids = [i for i in re.findall(r"'([^']*)'", query.get('constraint', ''))
+               if self.catalog.index(i) is not None]
+        start = int(query.get('startposition', 1))
+        count = min(int(query.get('maxrecords', 10)), self.catalog.options.csw_page_size)
+        page = ids[start - 1:start - 1 + count]
+        next_record = start + len(page)
+        if next_record > len(ids):
+            next_record = 0
+        records = ''.join([RECORD % {'id': i, 'title': i} for i in page])
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<csw:GetRecordsResponse %s><csw:SearchStatus timestamp="2000-01-01T00:00:00Z"/>'
+                '<csw:SearchResults numberOfRecordsMatched="%d" numberOfRecordsReturned="%d" '
+                'nextRecord="%d" elementSet="full">%s</csw:SearchResults></csw:GetRecordsResponse>'
+                % (CSW_NAMESPACES, len(ids), len(page), next_record, records))
+        self.send_body(body, 'application/xml')
+
+    def send_body(self, body, content_type, headers=None, code=200, ranges=False):
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        self.send_generated(lambda start, end: body[start:end], len(body),
+                            content_type, headers, etag, code, ranges)
+
+    def send_generated(self, get_bytes, size, content_type, headers=None,
+                       etag=None, code=200, ranges=True):
+        """Sends size bytes produced by get_bytes(start, end), honoring
+           If-None-Match, Range and If-Range for successful responses.
+        """
+        headers = dict(headers or {})
+        start, end = 0, size
+        if code == 200 and etag is not None:
+            headers['ETag'] = etag
+            if self.headers.get('if-none-match') == etag:
+                self.catalog.count('not_modified')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if ranges:
+                headers['Accept-Ranges'] = 'bytes'
+                requested = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('range', ''))
+                if_range = self.headers.get('if-range')
+                if requested and (if_range is None or if_range == etag):
+                    start = int(requested.group(1))
+                    if requested.group(2):
+                        end = min(int(requested.group(2)) + 1, size)
+                    if start >= size:
+                        self.send_response(416)
+                        self.send_header('Content-Range', 'bytes */%d' % size)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    code = 206
+                    headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
+                    self.catalog.count('partial')
+
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+
+        bandwidth = self.catalog.options.bandwidth
+        position = start
+        began = time.time()
+        while position < end:
+            chunk = get_bytes(position, min(position + CHUNK_SIZE, end))
+            self.wfile.write(chunk)
+            position += len(chunk)
+            self.catalog.count('bytes', len(chunk))
+            if bandwidth:
+                ahead = (position - start) * 1.0 / bandwidth - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, options):
+        BaseHTTPServer.HTTPServer.__init__(self, (options.host, options.port), Handler)
+        self.catalog = Catalog(options)
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up early, like a stopped extraction, are expected
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+def main(argv=None):
+    options, args = parser.parse_args(argv)
+    server = Server(options)
+    # The benchmark harness reads this line to know where the server is
+    print server.url
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""Benchmarks geonode-extract against the local fake GeoNode in
+   fake_geonode.py, so the effect of a change can be measured without a
+   live site and compared from one release to the next.
+
+   The server is started once with the given catalog, latency and bandwidth.
+   Then every scenario, a set of geonode-extract options, is run in a process
+   of its own into an empty directory, and the harness reports how many layers
+   per second and megabytes per second it achieved and its peak memory use.
+
+   Usage:
+
+    python benchmarks/run.py --layers 500 --latency 0.05 -s "-w 1" -s "-w 16"
+    python benchmarks/run.py --layers 20 --tiff-size 268435456 -s "-w 4 -r 8"
+"""
+from __future__ import with_statement
+
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import urllib2
+import platform
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+import fake_geonode
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Runs geonode-extract from this checkout, whatever version is installed
+EXTRACT = 'import sys; from extract.data import get_data; get_data(["geonode-extract"] + sys.argv[1:])'
+
+MB = 1024.0 * 1024.0
+
+parser = OptionParser(usage="%prog [options]")
+fake_geonode.add_server_options(parser)
+parser.set_defaults(port=0)
+parser.add_option("-s", "--scenario", dest="scenarios", action="append", default=[],
+                  help='geonode-extract options to benchmark, like "-w 8", may be given '
+                       'multiple times (default no options)', metavar="OPTIONS")
+parser.add_option("-n", "--repeat", dest="repeat", type="int", default=1,
+                  help="Number of times to run each scenario (default 1)")
+parser.add_option("-o", "--output", dest="output",
+                  help="Write the results as JSON to FILE", metavar="FILE")
+parser.add_option("-k", "--keep", dest="keep", action="store_true", default=False,
+                  help="Keep the directories the layers were extracted to")
+parser.add_option("-v", "--verbose", dest="verbose", action="store_true", default=False,
+                  help="Show the output of geonode-extract")
+
+
+def start_server(options):
+    """Starts fake_geonode.py in a process of its own, so it does not count
+       towards the time or memory of the extraction. Returns the process and
+       the url it listens on.
+    """
+    args = [sys.executable, os.path.join(BENCHMARKS_DIR, 'fake_geonode.py'),
+            '--host', options.host, '--port', str(options.port),
+            '--layers', str(options.layers),
+            '--page-size', str(options.page_size),
+            '--zip-size', str(options.zip_size),
+            '--tiff-size', str(options.tiff_size),
+            '--raster-ratio', str(options.raster_ratio),
+            '--latency', str(options.latency),
+            '--bandwidth', str(options.bandwidth),
+            '--csw-page-size', str(options.csw_page_size),
+            '--distinct', str(options.distinct),
+            '--capacity', str(options.capacity),
+            '--busy-ratio', str(options.busy_ratio)]
+    for name in options.fail:
+        args.extend(['--fail', name])
+    server = subprocess.Popen(args, stdout=subprocess.PIPE)
+    url = server.stdout.readline().strip()
+    if not url:
+        raise RuntimeError('The fake GeoNode did not start')
+    return server, url
+
+
+def get_stats(url, reset=False):
+    stats_url = url + '/_stats'
+    if reset:
+        stats_url += '?reset=1'
+    return json.loads(urllib2.urlopen(stats_url).read())
+
+
+def get_peak_rss(usage):
+    """Peak resident memory in megabytes, from the rusage of a process.
+    """
+    # Linux reports kilobytes, Mac OS X bytes
+    if sys.platform == 'darwin':
+        return usage.ru_maxrss / MB
+    return usage.ru_maxrss / 1024.0
+
+
+def count_layers(dest_dir):
+    # The style is the last part written, so there is one per finished layer
+    return len([f for f in os.listdir(dest_dir) if f.endswith('.sld')])
+
+
+def run_scenario(url, scenario, verbose=False):
+    """Extracts every layer served at url with the geonode-extract options in
+       scenario, in a new process and into a new directory. Returns a dict
+       with the measurements.
+    """
+    dest_dir = tempfile.mkdtemp(prefix='geonode-extract-benchmark-')
+    args = ([sys.executable, '-c', EXTRACT, url, '-d', dest_dir] +
+            shlex.split(scenario))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT_DIR, env.get('PYTHONPATH', '')])
+
+    get_stats(url, reset=True)
+    devnull = None
+    if not verbose:
+        devnull = open(os.devnull, 'w')
+    try:
+        started = time.time()
+        process = subprocess.Popen(args, env=env, stdout=devnull, stderr=devnull)
+        # Unlike wait, wait4 also returns the resources used by the process
+        pid, status, usage = os.wait4(process.pid, 0)
+        duration = time.time() - started
+    finally:
+        if devnull is not None:
+            devnull.close()
+    stats = get_stats(url)
+
+    layers = count_layers(dest_dir)
+    return {'scenario': scenario,
+            'exit_status': os.WEXITSTATUS(status),
+            'seconds': duration,
+            'layers': layers,
+            'layers_per_second': layers / duration,
+            'requests': stats['requests'],
+            'busy_responses': stats['busy'],
+            'peak_concurrency': stats['peak_concurrency'],
+            'megabytes': stats['bytes'] / MB,
+            'megabytes_per_second': stats['bytes'] / MB / duration,
+            'peak_rss_megabytes': get_peak_rss(usage),
+            'dest_dir': dest_dir}
+
+
+def print_results(results):
+    columns = [('scenario', '%-24s', '%-24s'),
+               ('seconds', '%9s', '%9.2f'),
+               ('layers', '%7s', '%7d'),
+               ('layers/s', '%9s', '%9.2f'),
+               ('requests', '%9s', '%9d'),
+               ('busy', '%6s', '%6d'),
+               ('MB', '%9s', '%9.1f'),
+               ('MB/s', '%8s', '%8.2f'),
+               ('peak RSS MB', '%12s', '%12.1f'),
+               ('exit', '%5s', '%5d')]
+    print ' '.join([header % name for name, header, row in columns])
+    for result in results:
+        values = [result['scenario'] or '(defaults)', result['seconds'],
+                  result['layers'], result['layers_per_second'],
+                  result['requests'], result['busy_responses'],
+                  result['megabytes'],
+                  result['megabytes_per_second'],
+                  result['peak_rss_megabytes'], result['exit_status']]
+        print ' '.join([row % value for (name, header, row), value
+                        in zip(columns, values)])
+
+
+def main(argv=None):
+    options, args = parser.parse_args(argv)
+    scenarios = options.scenarios or ['']
+
+    sys.path.insert(0, ROOT_DIR)
+    from extract import __version__
+
+    server, url = start_server(options)
+    results = []
+    try:
+        for scenario in scenarios:
+            for i in range(options.repeat):
+                result = run_scenario(url, scenario, options.verbose)
+                if not options.keep:
+                    shutil.rmtree(result.pop('dest_dir'))
+                results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+
+    print_results(results)
+
+    if options.output is not None:
+        server_options = dict((option.dest, getattr(options, option.dest))
+                              for option in fake_geonode.parser.option_list
+                              if option.dest is not None)
+        report = {'version': __version__,
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'server': server_options,
+                  'results': results}
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,338 @@
+"""Writes the extracted layers into a single tar archive instead of a
+   directory.
+
+   Millions of small files put a lot of pressure on shared filesystems. With
+   a LayerArchive every layer is extracted into a scratch directory on a
+   local disk first, and once it is complete its files are appended to the
+   archive, under a directory named after the layer, and removed.
+
+   The archive is only ever appended to. An index, a SQLite database, keeps
+   where the data of every file starts, how long it is and its SHA-256
+   digest, so single layers can be read back without scanning the whole
+   archive. While layers are being added the index is a file next to the
+   archive. When the archive is closed the index is appended to it as its
+   last member, followed by a small member that says where the index
+   starts, so the archive can be copied or moved on its own. The next
+   layer added writes over both. The archive is a regular tar file that any
+   tar program can read as well.
+"""
+from __future__ import with_statement
+
+import os
+import time
+import shutil
+import sqlite3
+import tarfile
+import logging
+import tempfile
+import threading
+from StringIO import StringIO
+
+from extract.store import HashingWriter
+
+log = logging.getLogger("geonode-extract")
+
+INDEX_SUFFIX = '.index.db'
+
+# Names of the members with the index and with where the index starts
+INDEX_MEMBER = 'geonode-extract.index.db'
+POINTER_MEMBER = 'geonode-extract.index'
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+# The header and data of the pointer, and the end of archive marker
+TRAILER_SIZE = 4 * BLOCK_SIZE
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_index_filename(filename):
+    return filename + INDEX_SUFFIX
+
+
+def get_member_name(layer, filename):
+    """Name of the file of a layer inside the archive.
+    """
+    name = layer
+    if ':' in name:
+        name = name.split(':')[1]
+    return '%s/%s' % (name, os.path.basename(filename))
+
+
+def write_member(out, name, source, size):
+    """Writes a member called name to out, with the size bytes of the file
+       object source as its data.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0644
+    out.write(info.tobuf(tarfile.USTAR_FORMAT))
+    shutil.copyfileobj(source, out, CHUNK_SIZE)
+    out.write('\0' * (-size % BLOCK_SIZE))
+
+
+def read_header(f, position):
+    """Returns the TarInfo of the header at position of f, or None if there
+       is no valid header there.
+    """
+    f.seek(position)
+    try:
+        return tarfile.TarInfo.frombuf(f.read(BLOCK_SIZE))
+    except tarfile.HeaderError:
+        return None
+
+
+def find_index(f):
+    """Returns where the data of the index appended to the archive open as f
+       starts and its size, or None if the archive does not end with one,
+       like when it was not closed.
+    """
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    if end < TRAILER_SIZE + BLOCK_SIZE:
+        return None
+    info = read_header(f, end - TRAILER_SIZE)
+    if info is None or info.name != POINTER_MEMBER:
+        return None
+    pointer = f.read(BLOCK_SIZE).strip()
+    if not pointer.isdigit():
+        return None
+    info = read_header(f, int(pointer))
+    if info is None or info.name != INDEX_MEMBER:
+        return None
+    return int(pointer) + BLOCK_SIZE, info.size
+
+
+def has_index(filename):
+    """Tells whether the archive filename has an index, next to it or
+       inside it, like the ones written by LayerArchive.
+    """
+    if os.path.exists(get_index_filename(filename)):
+        return True
+    with open(filename, 'rb') as f:
+        return find_index(f) is not None
+
+
+def copy_index(filename, index_filename):
+    """Copies the index appended to the archive filename to index_filename.
+       Returns False if the archive does not have one.
+    """
+    with open(filename, 'rb') as f:
+        index = find_index(f)
+        if index is None:
+            return False
+        start, size = index
+        f.seek(start)
+        with open(index_filename, 'wb') as out:
+            while size > 0:
+                data = f.read(min(CHUNK_SIZE, size))
+                if not data:
+                    raise IOError('"%s" is truncated' % filename)
+                out.write(data)
+                size -= len(data)
+    return True
+
+
+class LayerArchive(object):
+    """Tar archive with the files of every layer and an index to find them.
+
+       Layers are added whole with add_layer, which is safe to call from
+       several threads. An archive can be opened again to add more layers,
+       anything written after the last layer that made it into the index,
+       like by an extraction that was interrupted, is discarded.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = get_index_filename(filename)
+        if (not os.path.exists(self.index_filename) and os.path.exists(filename)
+                and os.path.getsize(filename) > 0):
+            # An archive that was closed, the index is inside it
+            if not copy_index(filename, self.index_filename):
+                msg = '"%s" has no index, it can not be added to' % filename
+                log.error(msg)
+                raise RuntimeError(msg)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.index_filename, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS layers ('
+                            ' layer TEXT PRIMARY KEY,'
+                            ' added REAL NOT NULL,'
+                            ' ends_at INTEGER NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS members ('
+                            ' layer TEXT NOT NULL,'
+                            ' name TEXT NOT NULL,'
+                            ' start INTEGER NOT NULL,'
+                            ' size INTEGER NOT NULL,'
+                            ' sha256 TEXT,'
+                            ' PRIMARY KEY (layer, name))')
+            self.db.commit()
+            row = self.db.execute('SELECT MAX(ends_at) FROM layers').fetchone()
+        self.end = row[0] or 0
+
+        if not os.path.exists(filename):
+            if self.end:
+                log.warning('"%s" is gone, starting it over' % filename)
+                with self.lock:
+                    self.db.execute('DELETE FROM members')
+                    self.db.execute('DELETE FROM layers')
+                    self.db.commit()
+                self.end = 0
+            open(filename, 'wb').close()
+        elif os.path.getsize(filename) < self.end:
+            msg = '"%s" is shorter than its index says, it can not be added to' % filename
+            log.error(msg)
+            raise RuntimeError(msg)
+        self.file = open(filename, 'r+b')
+        # Drops the end of archive marker, the index appended when the
+        # archive was closed and whatever was left half written
+        self.file.truncate(self.end)
+
+    def has_layer(self, layer):
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM layers WHERE layer=?',
+                                  (layer,)).fetchone()
+        return row is not None
+
+    def add_layer(self, layer, filenames):
+        """Appends the files of layer to the archive and records them in the
+           index. Returns the number of bytes written to the archive.
+        """
+        with self.lock:
+            self.file.seek(self.end)
+            members = []
+            for filename in sorted(filenames):
+                info = tarfile.TarInfo(get_member_name(layer, filename))
+                info.size = os.path.getsize(filename)
+                info.mtime = int(os.path.getmtime(filename))
+                info.mode = 0644
+                self.file.write(info.tobuf(tarfile.PAX_FORMAT))
+                offset = self.file.tell()
+                writer = HashingWriter(self.file)
+                with open(filename, 'rb') as f:
+                    shutil.copyfileobj(f, writer, CHUNK_SIZE)
+                padding = -info.size % BLOCK_SIZE
+                self.file.write('\0' * padding)
+                members.append((layer, info.name, offset, info.size, writer.hexdigest()))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+            written = self.file.tell() - self.end
+            self.end = self.file.tell()
+            # Readers of the tar file need the end of archive marker, which
+            # the next layer writes over.
+            self.file.write('\0' * BLOCK_SIZE * 2)
+            self.file.flush()
+
+            self.db.execute('DELETE FROM members WHERE layer=?', (layer,))
+            self.db.executemany('INSERT INTO members (layer, name, start, size, sha256)'
+                                ' VALUES (?, ?, ?, ?, ?)', members)
+            self.db.execute('INSERT OR REPLACE INTO layers (layer, added, ends_at)'
+                            ' VALUES (?, ?, ?)', (layer, time.time(), self.end))
+            self.db.commit()
+        log.debug('Added %d files of "%s" to "%s"' % (len(members), layer, self.filename))
+        return written
+
+    def close(self):
+        """Appends the index to the archive and removes the one next to it.
+        """
+        with self.lock:
+            # A single file without a write ahead log, to be copied as is
+            self.db.execute('PRAGMA journal_mode=DELETE')
+            self.db.close()
+
+            self.file.seek(self.end)
+            self.file.truncate()
+            with open(self.index_filename, 'rb') as index:
+                write_member(self.file, INDEX_MEMBER, index,
+                             os.path.getsize(self.index_filename))
+            pointer = '%0*d' % (BLOCK_SIZE - 1, self.end) + '\n'
+            write_member(self.file, POINTER_MEMBER, StringIO(pointer), len(pointer))
+            self.file.write('\0' * BLOCK_SIZE * 2)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            os.remove(self.index_filename)
+
+
+class ArchiveReader(object):
+    """Reads single layers back from an archive written by LayerArchive,
+       using its index.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.copy = None
+        index_filename = get_index_filename(filename)
+        if not os.path.exists(index_filename):
+            # The archive was closed, the index is inside it
+            handle, self.copy = tempfile.mkstemp(suffix=INDEX_SUFFIX)
+            os.close(handle)
+            if not copy_index(filename, self.copy):
+                os.remove(self.copy)
+                msg = '"%s" has no index, it was not written by geonode-extract' % filename
+                log.error(msg)
+                raise RuntimeError(msg)
+            index_filename = self.copy
+        self.db = sqlite3.connect(index_filename)
+        self.db.row_factory = sqlite3.Row
+        self.file = open(filename, 'rb')
+
+    def layers(self):
+        """Returns the names of the layers in the archive, in the order they
+           were added.
+        """
+        rows = self.db.execute('SELECT layer FROM layers ORDER BY ends_at').fetchall()
+        return [row['layer'] for row in rows]
+
+    def has_layer(self, layer):
+        row = self.db.execute('SELECT 1 FROM layers WHERE layer=?', (layer,)).fetchone()
+        return row is not None
+
+    def members(self, layer):
+        """Returns the 'name', 'start', 'size' and 'sha256' digest of the files
+           of layer as dicts.
+        """
+        rows = self.db.execute('SELECT name, start, size, sha256 FROM members'
+                               ' WHERE layer=? ORDER BY name', (layer,)).fetchall()
+        return [dict(zip(row.keys(), row)) for row in rows]
+
+    def read(self, layer, name):
+        """Returns the contents of the file called name of layer, as it is
+           named in the archive.
+        """
+        row = self.db.execute('SELECT start, size FROM members WHERE layer=? AND name=?',
+                              (layer, name)).fetchone()
+        if row is None:
+            raise KeyError('There is no "%s" for "%s" in "%s"' % (
+                              name, layer, self.filename))
+        self.file.seek(row['start'])
+        return self.file.read(row['size'])
+
+    def extract(self, layer, dest_dir):
+        """Writes the files of layer into dest_dir, and returns their paths.
+        """
+        filenames = []
+        for member in self.members(layer):
+            filename = os.path.join(dest_dir, os.path.basename(member['name']))
+            self.file.seek(member['start'])
+            remaining = member['size']
+            with open(filename, 'wb') as f:
+                while remaining > 0:
+                    data = self.file.read(min(CHUNK_SIZE, remaining))
+                    if not data:
+                        raise IOError('"%s" is truncated' % self.filename)
+                    f.write(data)
+                    remaining -= len(data)
+            filenames.append(filename)
+        return filenames
+
+    def close(self):
+        self.file.close()
+        self.db.close()
+        if self.copy is not None:
+            os.remove(self.copy)
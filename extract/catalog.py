@@ -0,0 +1,180 @@
+from __future__ import with_statement
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from extract import filters
+
+CACHE_FILENAME = 'catalog.db'
+
+# Fields of the rows of the search api that are kept, the ones the
+# extraction uses and the ones layers are filtered by.
+CACHED_FIELDS = ['name', 'title', 'download_links', 'metadata_links'] + filters.FIELDS
+
+# Rows are read back from the cache this many at a time
+BATCH_SIZE = 1000
+
+
+def get_cache_dir():
+    """Default directory of the catalog cache, following the XDG base
+       directory specification.
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'geonode-extract')
+
+
+def get_cache_key(url, query):
+    # The query is the text searched for, or a dict with every parameter
+    # of the search api
+    return json.dumps([url, query], sort_keys=True)
+
+
+class CatalogCache(object):
+    """Keeps the layers returned by the search api of a GeoNode, for a url
+       and a query, so later extractions can start without paging through
+       the whole catalog again.
+
+       Layers are added page by page while the catalog is read, and the entry
+       is marked complete once the last page is in. Entries that were cut
+       short, like when only --limit layers were asked for, can still serve
+       that many layers. It is stored as a SQLite database and it is safe to
+       share between threads.
+    """
+
+    def __init__(self, cache_dir=None, filename=CACHE_FILENAME):
+        if cache_dir is None:
+            cache_dir = get_cache_dir()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.path = os.path.join(cache_dir, filename)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS catalogs ('
+                            ' key TEXT PRIMARY KEY,'
+                            ' url TEXT NOT NULL,'
+                            ' query TEXT,'
+                            ' total INTEGER NOT NULL,'
+                            ' rows INTEGER NOT NULL DEFAULT 0,'
+                            ' complete INTEGER NOT NULL DEFAULT 0,'
+                            ' fetched REAL NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS layers ('
+                            ' key TEXT NOT NULL,'
+                            ' position INTEGER NOT NULL,'
+                            ' row TEXT NOT NULL,'
+                            ' PRIMARY KEY (key, position))')
+            self.db.commit()
+
+    def get(self, url, query, ttl, limit=None):
+        """Returns the entry of url and query as a dict, if it was fetched
+           less than ttl seconds ago and has all the layers, or at least
+           `limit` of them. Otherwise returns None.
+        """
+        key = get_cache_key(url, query)
+        with self.lock:
+            row = self.db.execute('SELECT * FROM catalogs WHERE key=?',
+                                  (key,)).fetchone()
+        if row is None:
+            return None
+        entry = dict(zip(row.keys(), row))
+        if time.time() - entry['fetched'] > ttl:
+            return None
+        if not entry['complete'] and (limit is None or entry['rows'] < limit):
+            return None
+        return entry
+
+    def rows(self, key, limit=None):
+        """Yields the layers of an entry in the order the search api gave them.
+        """
+        position = 0
+        while limit is None or position < limit:
+            size = BATCH_SIZE
+            if limit is not None:
+                size = min(size, limit - position)
+            with self.lock:
+                batch = self.db.execute('SELECT position, row FROM layers'
+                                        ' WHERE key=? AND position>=?'
+                                        ' ORDER BY position LIMIT ?',
+                                        (key, position, size)).fetchall()
+            if not batch:
+                break
+            for row in batch:
+                yield json.loads(row['row'])
+            position = batch[-1]['position'] + 1
+
+    def start(self, url, query, total):
+        """Replaces the entry of url and query with an empty one, and returns
+           its key to add layers to it.
+        """
+        key = get_cache_key(url, query)
+        with self.lock:
+            self.db.execute('DELETE FROM layers WHERE key=?', (key,))
+            self.db.execute('INSERT OR REPLACE INTO catalogs'
+                            ' (key, url, query, total, rows, complete, fetched)'
+                            ' VALUES (?, ?, ?, ?, 0, 0, ?)',
+                            (key, url, json.dumps(query), total, time.time()))
+            self.db.commit()
+        return key
+
+    def add(self, key, position, layers):
+        """Adds the layers of a page, the first of them at position.
+        """
+        rows = []
+        for i, layer in enumerate(layers):
+            row = dict((k, layer[k]) for k in CACHED_FIELDS if k in layer)
+            rows.append((key, position + i, json.dumps(row)))
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO layers (key, position, row)'
+                                ' VALUES (?, ?, ?)', rows)
+            self.db.execute('UPDATE catalogs SET rows=MAX(rows, ?) WHERE key=?',
+                            (position + len(rows), key))
+            self.db.commit()
+
+    def finish(self, key):
+        """Marks an entry as having every layer of the catalog.
+        """
+        with self.lock:
+            self.db.execute('UPDATE catalogs SET complete=1 WHERE key=?', (key,))
+            self.db.commit()
+
+    def invalidate(self, url=None, query=None):
+        """Forgets the entry of url and query, or every entry if no url is given.
+        """
+        with self.lock:
+            if url is None:
+                self.db.execute('DELETE FROM layers')
+                self.db.execute('DELETE FROM catalogs')
+            else:
+                key = get_cache_key(url, query)
+                self.db.execute('DELETE FROM layers WHERE key=?', (key,))
+                self.db.execute('DELETE FROM catalogs WHERE key=?', (key,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class CachedLayerList(object):
+    """Lazy list of the layers of a CatalogCache entry, that stands in for
+       a LayerList.
+    """
+
+    def __init__(self, cache, entry, limit=None):
+        self.cache = cache
+        self.key = entry['key']
+        self.limit = limit
+        self.fetched = entry['fetched']
+        self.total = entry['total']
+        self.number = self.total
+        if limit is not None and limit < self.total:
+            self.number = limit
+
+    def __iter__(self):
+        return self.cache.rows(self.key, self.limit)
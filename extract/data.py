@@ -3,15 +3,36 @@ from __future__ import with_statement
 import os
 import sys
 import json
+import time
+import Queue
 import zipfile
+import hashlib
+import shutil
+import tempfile
+import itertools
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+import urllib
 import urlparse
 import logging
 import datetime
 from extract import __version__
+from extract import green
+from extract import xmlstream
+from extract import zipstream
+from extract import planner
+from extract import filters
+from extract.catalog import CatalogCache, CachedLayerList
+from extract.manifest import Manifest, get_manifest_filename
+from extract.scheduler import BACKOFF, Limiter, RetryingSession
+from extract.report import Report, JSONLinesWriter, PHASES, load_hook, measure
+from extract.report import merge_reports, write_report
+from extract.store import BlobStore, HashingWriter, get_digest
+from extract.archive import LayerArchive, ArchiveReader, has_index
+from extract import verify
 from optparse import OptionParser
 import traceback as tb
-from xml.dom import minidom
 
 log = logging.getLogger("geonode-extract")
 
@@ -23,6 +44,8 @@ except ImportError:
         def emit(self, record): pass
 log.addHandler(NullHandler())
 
+SUPPORTED_FORMATS = ['zip', 'tiff']
+
 parser = OptionParser(usage="%prog <geonode_url> [options]",
                       version="%prog " + __version__)
 
@@ -38,35 +61,578 @@ parser.add_option("-l", "--limit", dest="limit", type="int",
                           help="Limit the number of layers to be extracted")
 parser.add_option("-q", "--query", dest="query",
                           help="Search terms")
+parser.add_option("-t", "--type", dest="layer_type", type="choice", choices=filters.TYPES,
+                          help="Only extract vector or raster layers")
+parser.add_option("--bbox", dest="bbox",
+                          help="Only extract layers that intersect the bounding box MINX,MINY,MAXX,MAXY",
+                          metavar="MINX,MINY,MAXX,MAXY")
+parser.add_option("--modified-since", dest="modified_since",
+                          help="Only extract layers changed on or after DATE, like 2013-05-01",
+                          metavar="DATE")
+parser.add_option("-n", "--name", dest="names", action="append", default=[],
+                          help="Only extract the layer NAME, may be given multiple times", metavar="NAME")
+parser.add_option("--names-file", dest="names_file",
+                          help="Only extract the layers named in FILE, one per line", metavar="FILE")
+parser.add_option("-f", "--formats", dest="formats",
+                          help="Download the data in the first of FORMATS each layer has, and skip the "
+                               "layers that have none of them (default %s)" % ','.join(SUPPORTED_FORMATS),
+                          metavar="FORMATS")
+parser.add_option("-w", "--workers", dest="workers", type="int", default=1,
+                          help="Number of layers to extract concurrently", metavar="N")
+parser.add_option("-e", "--engine", dest="engine", default="threads",
+                          type="choice", choices=["threads", "gevent"],
+                          help="Run the workers as threads, or as gevent coroutines to keep thousands "
+                               "of requests in flight (default threads)")
+parser.add_option("--chunk-size", dest="chunk_size", type="int", default=None,
+                          help="Size in bytes of the blocks used to write downloads to disk (default 64 KB)",
+                          metavar="BYTES")
+parser.add_option("-r", "--ranges", dest="ranges", type="int", default=1,
+                          help="Split downloads of large files in N byte ranges fetched concurrently",
+                          metavar="N")
+parser.add_option("-x", "--raw-xml", action="store_false", dest="pretty_xml", default=True,
+                          help="Write metadata and styles as they come instead of pretty printing them")
+parser.add_option("-b", "--bulk-metadata", dest="bulk_metadata", type="int",
+                          help="Harvest metadata with CSW GetRecords requests for N layers at a time",
+                          metavar="N")
+parser.add_option("--dedupe", action="store_true", dest="dedupe", default=False,
+                          help="Keep a single copy of identical files, in the .blobs directory of the "
+                               "destination, and hard link the files of the layers to it")
+parser.add_option("-s", "--sync", action="store_true", dest="sync", default=False,
+                          help="Check layers that were already extracted and download the parts that changed")
+parser.add_option("--retries", dest="retries", type="int", default=3,
+                          help="Retry requests that fail because the server is busy or times out N times, "
+                               "waiting longer every time (default 3)", metavar="N")
+parser.add_option("--backoff", dest="backoff", type="float", default=BACKOFF,
+                          help="Seconds to wait before the first retry, unless the server asks for longer "
+                               "(default 1)", metavar="SECONDS")
+parser.add_option("--timeout", dest="timeout", type="float", default=60,
+                          help="Give up on requests that get no data for this long (default 60)",
+                          metavar="SECONDS")
+parser.add_option("-a", "--adaptive", action="store_true", dest="adaptive", default=False,
+                          help="Extract fewer layers at a time when the server slows down or pushes back, "
+                               "and go back up to --workers as it recovers")
+parser.add_option("--cache-ttl", dest="cache_ttl", type="float",
+                          help="Keep the list of layers in a cache and reuse it for this long, instead of "
+                               "paging through the catalog on every run", metavar="SECONDS")
+parser.add_option("--refresh-catalog", action="store_true", dest="refresh_catalog", default=False,
+                          help="Read the list of layers from the catalog and replace the cached one")
+parser.add_option("--cache-dir", dest="cache_dir",
+                          help="Where to keep the cached lists of layers (default ~/.cache/geonode-extract)",
+                          metavar="PATH")
+parser.add_option("--shard", dest="shard",
+                          help="Extract only the Kth of N disjoint slices of the layers, so N hosts can "
+                               "share the work. Each keeps its own manifest in the destination",
+                          metavar="K/N")
+parser.add_option("--merge", dest="merge", action="append", default=[],
+                          help="Instead of extracting, merge the --report FILE of a shard into the one "
+                               "given with --report, may be given multiple times", metavar="FILE")
+parser.add_option("--report", dest="report",
+                          help="Write the time and bytes of every phase of every layer, the slowest layers "
+                               "and the throughput of every host to FILE as JSON. The phases of every "
+                               "layer are kept in memory until the end, use --events for very large "
+                               "catalogs", metavar="FILE")
+parser.add_option("--timings", dest="timings",
+                          help="Append every phase of every layer to FILE as a line of JSON as soon as it "
+                               "finishes", metavar="FILE")
+parser.add_option("--events", dest="events",
+                          help="Append the outcome of every layer, with the traceback of the ones that "
+                               "failed, to FILE as a line of JSON as soon as it finishes", metavar="FILE")
+parser.add_option("--report-hook", dest="report_hooks", action="append", default=[],
+                          help="Call the Python function FUNCTION in MODULE with every phase of every layer "
+                               "as soon as it finishes, may be given multiple times",
+                          metavar="MODULE:FUNCTION")
+parser.add_option("--schedule", dest="schedule", default="catalog",
+                          help="Order to extract the layers in: catalog, the order of the search api, "
+                               "largest or smallest, by the size of their data, found out with HEAD "
+                               "requests before the extraction starts, or a Python function given as "
+                               "MODULE:FUNCTION (default %default)", metavar="POLICY")
+parser.add_option("--archive", dest="archive",
+                          help="Write the layers into the tar archive FILE, with an index at its end to "
+                               "read single layers back, instead of into --dest-dir. Layers are only "
+                               "ever appended, the ones already in it are skipped. While layers are "
+                               "added the index is kept next to it, in FILE.index.db", metavar="FILE")
+parser.add_option("--scratch-dir", dest="scratch_dir",
+                          help="Where layers are kept until they are added to the --archive, best on a "
+                               "local disk (default the system temporary directory)", metavar="PATH")
+parser.add_option("--verify", action="store_true", dest="verify", default=False,
+                          help="Do not extract anything, instead check the files in --dest-dir, or in the "
+                               "--archive, against the SHA-256 digests recorded when they were written, "
+                               "using one thread per core or --workers. No geonode_url is needed")
+parser.add_option("--plan", action="store_true", dest="plan", default=False,
+                          help="Do not extract anything, instead find out the size and number of files "
+                               "of every layer, and estimate how long the extraction would take with "
+                               "the given options. The plan is written to the --report FILE, if given")
 parser.add_option("-v", dest="verbose", default=1, action="count",
                       help="increment output verbosity; may be specified multiple times")
 
-SUPPORTED_FORMATS = ['zip', 'tiff']
+CHUNK_SIZE = 64 * 1024
+
+# Files smaller than this are always downloaded with a single request
+RANGE_MIN_SIZE = 64 * 1024 * 1024
+
+# Longest GetRecords constraint sent in a query string, once URL encoded.
+# Servers commonly refuse request lines longer than 8 KB.
+MAX_CONSTRAINT_LENGTH = 6 * 1024
 
 
 def get_parser():
     return parser
 
-def get_style(layer, url, username=None, password=None):
-    """Downloads the associated SLD file for a given GeoNode layer
+def get_session(username=None, password=None, workers=1, retries=0,
+                backoff=BACKOFF, timeout=None, limiter=None):
+    """Creates the HTTP session shared by all the requests of an extraction.
 
-       The current implementation goes to the layer's detail page and follows the
-       link to the GeoServer's REST API endpoint. It needs the username and password,
-       because by default GeoServer restricts read access to those.
+       Connections are kept alive and pooled per host, with room for `workers`
+       connections so concurrent requests do not have to wait for each other
+       or open new connections. If a username is given it is
+       used for every request, GeoServer needs it to serve the styles.
 
-       It returns the raw content of the SLD file in text format.
+       Requests that fail because the server is busy are retried up to
+       `retries` times, and the limiter, if any, is told how every request
+       went, see scheduler.RetryingSession.
+    """
+    session = RetryingSession(retries, backoff, timeout, limiter)
+    adapter = HTTPAdapter(pool_connections=10,
+                          pool_maxsize=max(workers, 10))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if username is not None:
+        session.auth = (username, password)
+    return session
+
+def get_layer_filename(layer, dest_dir):
+    """Returns the path in dest_dir where the data of layer is written.
+    """
+    filename = layer['name']
+
+    # Strip out the 'geonode:' if it exists
+    if ':' in filename:
+        filename = layer['name'].split(':')[1]
+
+    return os.path.join(dest_dir, filename)
+
+def is_layer_done(layer, dest_dir, manifest=None, archive=None):
+    """Tells whether layer was already extracted, to the archive if one is
+       given, or else to dest_dir.
+    """
+    if archive is not None:
+        return archive.has_layer(layer['name'])
+    if manifest is not None and manifest.has_layer(layer['name']):
+        return manifest.is_layer_complete(layer['name'])
+    # Layers extracted without a manifest are complete once the style,
+    # which is downloaded last, is there.
+    return os.path.exists(get_layer_filename(layer, dest_dir) + '.sld')
+
+def get_style_url(layer, url):
+    """Returns the url of the SLD file for a given GeoNode layer in GeoServer's
+       REST API.
     """
-    # Get the style json information from GeoServer's REST API
     if ':' in layer['name']:
         name = layer['name'].split(':')[1]
     else:
         name = layer['name']
 
-    style_raw_url = urlparse.urljoin(url, '/geoserver/styles/' +  name + '.sld')
-    req = requests.get(style_raw_url, auth=(username, password))
+    return urlparse.urljoin(url, '/geoserver/styles/' +  name + '.sld')
+
+def get_style(layer, url, username=None, password=None, session=None):
+    """Downloads the associated SLD file for a given GeoNode layer
+
+       The current implementation goes to the layer's detail page and follows the
+       link to the GeoServer's REST API endpoint. It needs the username and password,
+       because by default GeoServer restricts read access to those. When a session
+       is given it is expected to carry the credentials already.
+
+       It returns the raw content of the SLD file in text format.
+    """
+    if session is None:
+        session = get_session(username, password)
+
+    style_raw_url = get_style_url(layer, url)
+    req = session.get(style_raw_url)
     return req.content
 
-def download_layer(layer, url,  dest_dir, username=None, password=None):
+def fetch_part(session, link, layer, part, manifest=None, sync=False,
+               headers=None, **kwargs):
+    """Requests one part of a layer, 'data', 'metadata' or 'style', from link.
+
+       When there is a manifest, parts that it records as complete are not
+       requested again, unless sync is set. In that case they are requested
+       with the ETag and Last-Modified seen the last time. If the server says
+       the part did not change, or it was not requested at all, this returns
+       None instead of the response.
+
+       Raises requests.HTTPError if the server answered with an error, other
+       than 416 for a range it can not serve.
+    """
+    headers = dict(headers or {})
+    if manifest is not None and manifest.is_complete(layer['name'], part):
+        if not sync:
+            log.debug('The %s of "%s" was already downloaded' % (part, layer['name']))
+            return None
+        headers.update(manifest.conditional_headers(layer['name'], part))
+
+    r = session.get(link, headers=headers, **kwargs)
+    if r.status_code == 304:
+        log.debug('The %s of "%s" did not change' % (part, layer['name']))
+        r.close()
+        return None
+    # A range past the end of the file is not an error, the caller starts
+    # over. Anything else that failed must not be saved and recorded as the
+    # part, like the page of a busy server or an exception report.
+    if r.status_code != 416 and r.status_code >= 400:
+        r.close()
+        r.raise_for_status()
+
+    if manifest is not None:
+        manifest.start(layer['name'], part, link, r)
+    return r
+
+def get_expected_size(r):
+    """Returns the size of the whole file served by a (partial) response,
+       or None if the server did not say.
+    """
+    if r.status_code == 206:
+        # Content-Range looks like 'bytes 1000-4999/5000'
+        content_range = r.headers.get('content-range', '')
+        total = content_range.rpartition('/')[2]
+        if total.isdigit():
+            return int(total)
+        return None
+
+    # The length of compressed responses has nothing to do with the file size
+    if 'content-encoding' in r.headers:
+        return None
+    content_length = r.headers.get('content-length')
+    if content_length is not None and content_length.isdigit():
+        return int(content_length)
+    return None
+
+def download_ranges(session, r, link, filename, size, ranges, chunk_size=CHUNK_SIZE):
+    """Writes the file served by r into filename using `ranges` concurrent
+       requests, each for a different byte range of it.
+
+       The file is allocated with its final size up front and every range is
+       written at its own offset. The body of r itself is used for the first
+       range. If something goes wrong, the file is truncated to the part that
+       was written without gaps from the beginning, so it can be resumed.
+    """
+    step = -(-size // ranges)
+    segments = [(start, min(start + step, size)) for start in range(0, size, step)]
+    written = [0] * len(segments)
+    errors = []
+
+    # Make sure every range is served from the same version of the file
+    validator = r.headers.get('etag') or r.headers.get('last-modified')
+
+    with open(filename, 'wb') as layer_file:
+        layer_file.truncate(size)
+
+    def fetch(i):
+        start, end = segments[i]
+        try:
+            if i == 0:
+                response = r
+            else:
+                headers = {'Range': 'bytes=%d-%d' % (start, end - 1),
+                           'If-Range': validator}
+                response = session.get(link, headers=headers, stream=True)
+            try:
+                if i > 0 and response.status_code != 206:
+                    raise RuntimeError('Expected bytes %d-%d of "%s" but got status %d' %
+                                       (start, end - 1, link, response.status_code))
+                with open(filename, 'r+b') as layer_file:
+                    layer_file.seek(start)
+                    for chunk in response.iter_content(chunk_size):
+                        # The first response carries the whole file, stop at
+                        # the end of its range.
+                        chunk = chunk[:end - start - written[i]]
+                        layer_file.write(chunk)
+                        written[i] += len(chunk)
+                        if written[i] == end - start:
+                            break
+            finally:
+                response.close()
+        except Exception, e:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=fetch, args=(i,)) for i in range(1, len(segments))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    fetch(0)
+    for thread in threads:
+        thread.join()
+
+    for (start, end), count in zip(segments, written):
+        if count != end - start and not errors:
+            errors.append((RuntimeError, RuntimeError(
+                'Got %d of %d bytes for range %d-%d of "%s"' %
+                (count, end - start, start, end - 1, link)), None))
+
+    if errors:
+        prefix = 0
+        for (start, end), count in zip(segments, written):
+            prefix += count
+            if count != end - start:
+                break
+        with open(filename, 'r+b') as layer_file:
+            layer_file.truncate(prefix)
+        error = errors[0]
+        raise error[0], error[1], error[2]
+
+def download_data(session, link, layer, layer_filename, manifest=None,
+                  sync=False, chunk_size=CHUNK_SIZE, ranges=1,
+                  min_range_size=RANGE_MIN_SIZE, report=None, store=None):
+    """Downloads the data file of a layer into layer_filename.
+
+       The file is written as layer_filename + '.part' and only moved into
+       place once it has the length the server announced. If a previous run
+       left a .part file behind and the manifest shows the server supports
+       byte ranges, only the missing bytes are requested.
+
+       Files of at least min_range_size bytes are fetched with `ranges`
+       concurrent requests when the server supports byte ranges, see
+       download_ranges.
+
+       Zip archives that are downloaded in one go are unpacked while they
+       arrive, each member is written straight to the name of the layer
+       with the extension of the member and the archive itself never touches
+       the disk. Archives that come from a resumed or split download are
+       unpacked from the .part file instead.
+
+       The transfer, and the unpacking of archives from the .part file, are
+       measured in report if one is given. The SHA-256 digest and size of the
+       files are computed on the way to disk and recorded in the manifest,
+       only files that are resumed or split in ranges have to be read back to
+       hash them. With a BlobStore, the files
+       are added to it.
+
+       Returns the list of files that were written, or None if the data was
+       not downloaded again, see fetch_part.
+    """
+    part_filename = layer_filename + '.part'
+
+    headers = None
+    offset = 0
+    if manifest is not None and os.path.exists(part_filename):
+        offset = os.path.getsize(part_filename)
+        headers = manifest.resume_headers(layer['name'], 'data', link, offset)
+
+    base_filename, extension = os.path.splitext(layer_filename)
+
+    def get_member_filename(name):
+        log.debug('Found "%s" in the archive of "%s"' % (name, layer['name']))
+        _, extension = os.path.splitext(name)
+        filename = base_filename + extension
+        log.debug('Saving "%s" to "%s"' % (name, filename))
+        # Members are written in place, so an old version that may be a
+        # link into the blob store has to go first.
+        if os.path.exists(filename):
+            os.remove(filename)
+        return filename
+
+    # Files hashed while they were written
+    writers = {}
+
+    def open_member(filename):
+        writer = HashingWriter(open(filename, 'wb'))
+        writers[filename] = writer
+        return writer
+
+    data_files = None
+    received = [0]
+
+    def count(chunks):
+        for chunk in chunks:
+            received[0] += len(chunk)
+            yield chunk
+
+    with measure(report, layer['name'], 'transfer', link) as record:
+        r = fetch_part(session, link, layer, 'data', manifest, sync,
+                       headers=headers, stream=True)
+        if r is not None and r.status_code == 416:
+            # The partial file is no good, start over.
+            r.close()
+            headers = None
+            r = fetch_part(session, link, layer, 'data', manifest, sync, stream=True)
+        if r is None:
+            return None
+
+        try:
+            if 'content-disposition' not in r.headers:
+                msg = ('Layer "%s" did not have a valid download link "%s"' %
+                        (layer['name'], link))
+                log.error(msg)
+                raise RuntimeError(msg)
+
+            size = get_expected_size(r)
+            can_split = (r.status_code == 200 and size is not None and size > 0 and
+                         r.headers.get('accept-ranges') == 'bytes' and
+                         ('etag' in r.headers or 'last-modified' in r.headers))
+
+            if ranges > 1 and can_split and size >= min_range_size:
+                log.debug('Downloading "%s" in %d ranges' % (layer['name'], ranges))
+                download_ranges(session, r, link, part_filename, size, ranges, chunk_size)
+                mode = None
+            elif r.status_code == 206:
+                if not r.headers.get('content-range', '').startswith('bytes %d-' % offset):
+                    msg = ('Server sent the wrong range to resume layer "%s": "%s"' %
+                            (layer['name'], r.headers.get('content-range')))
+                    log.error(msg)
+                    raise RuntimeError(msg)
+                log.debug('Resuming download of "%s" after %d bytes' % (layer['name'], offset))
+                mode = 'ab'
+            else:
+                # The server sent the whole file, even if a range was asked for.
+                mode = 'wb'
+
+            chunks = count(r.iter_content(chunk_size))
+            if mode == 'wb':
+                first = next(chunks, '')
+                chunks = itertools.chain([first], chunks)
+                if first.startswith(zipstream.LOCAL_HEADER):
+                    log.debug('Layer "%s" is zipped, unpacking it while downloading' % layer['name'])
+                    data_files = zipstream.unpack(chunks, get_member_filename, chunk_size,
+                                                  open_member)
+                    # The central directory is not needed, but it is read anyway
+                    # so the size of the whole archive can be checked.
+                    for chunk in chunks:
+                        pass
+                    mode = None
+                    if os.path.exists(part_filename):
+                        os.remove(part_filename)
+
+            if mode is not None:
+                with open(part_filename, mode) as layer_file:
+                    if mode == 'wb':
+                        layer_file = writers[layer_filename] = HashingWriter(layer_file)
+                    for chunk in chunks:
+                        layer_file.write(chunk)
+        finally:
+            r.close()
+
+        if data_files is None:
+            size = os.path.getsize(part_filename)
+        else:
+            size = received[0]
+        record['bytes'] = size
+        expected_size = get_expected_size(r)
+        if expected_size is not None and size != expected_size:
+            msg = ('Download of layer "%s" was incomplete, got %d of %d bytes' %
+                    (layer['name'], size, expected_size))
+            log.error(msg)
+            raise RuntimeError(msg)
+        log.debug('Finished downloading data for "%s"' % layer['name'])
+
+    if data_files is None:
+        if os.path.exists(layer_filename):
+            os.remove(layer_filename)
+        os.rename(part_filename, layer_filename)
+        log.debug('Saved data from "%s" as "%s"' % (layer['name'], layer_filename))
+        data_files = [layer_filename]
+
+        # If this file a zipfile, unpack all files with the same base_filename
+        # and remove the downloaded zip
+        if zipfile.is_zipfile(layer_filename):
+            log.debug('Layer "%s" is zipped, unpacking now' % layer_filename)
+            data_files = []
+            with measure(report, layer['name'], 'unzip') as record:
+                # Create a ZipFile object
+                z = zipfile.ZipFile(layer_filename)
+                try:
+                    for f in z.namelist():
+                        if f.endswith('/'):
+                            continue
+                        # Members go straight to their own name, never to the
+                        # one in the archive, which may be another layer's
+                        # file linked into the blob store.
+                        filename = get_member_filename(f)
+                        member = z.open(f)
+                        try:
+                            with open_member(filename) as out:
+                                shutil.copyfileobj(member, out, chunk_size)
+                        finally:
+                            member.close()
+                        data_files.append(filename)
+                        record['bytes'] += os.path.getsize(filename)
+                finally:
+                    z.close()
+            log.debug('Removing "%s" because it is not needed anymore' % layer_filename)
+            os.remove(layer_filename)
+
+    digests = get_digests(data_files, writers)
+    if store is not None:
+        for filename in data_files:
+            store.add(filename, digests[filename]['sha256'])
+
+    if manifest is not None:
+        manifest.finish(layer['name'], 'data', r, size, data_files, digests)
+    return data_files
+
+def get_digests(filenames, writers=None):
+    """Returns the SHA-256 digest and size of every file as a dict, taken
+       from the HashingWriter it was written with, if it is in writers, or
+       from reading the file otherwise.
+    """
+    writers = writers or {}
+    digests = {}
+    for filename in filenames:
+        if filename in writers:
+            writer = writers[filename]
+            digests[filename] = {'sha256': writer.hexdigest(), 'size': writer.size}
+        else:
+            digests[filename] = {'sha256': get_digest(filename),
+                                 'size': os.path.getsize(filename)}
+    return digests
+
+def download_xml(r, filename, unwrap=None, pretty=True, chunk_size=CHUNK_SIZE,
+                 store=None, digests=None):
+    """Writes the XML document in the response r into filename while it is
+       being downloaded, see xmlstream.write_xml. Documents that need no
+       changes are copied as they come without parsing them. The document is
+       added to the BlobStore store, if one is given.
+
+       The SHA-256 digest and size of what was written are added to the
+       dict digests, if one is given, see get_digests. Returns the number of
+       bytes received.
+    """
+    part_filename = filename + '.part'
+    size = [0]
+
+    def count(chunks):
+        for chunk in chunks:
+            size[0] += len(chunk)
+            yield chunk
+
+    try:
+        with open(part_filename, 'wb') as xml_file:
+            xml_file = writer = HashingWriter(xml_file)
+            chunks = count(r.iter_content(chunk_size))
+            if pretty or unwrap is not None:
+                xmlstream.write_xml(chunks, xml_file, unwrap, pretty)
+            else:
+                for chunk in chunks:
+                    xml_file.write(chunk)
+    except Exception, e:
+        # Unlike data files, documents are small enough to start over.
+        os.remove(part_filename)
+        raise e
+    finally:
+        r.close()
+
+    if os.path.exists(filename):
+        os.remove(filename)
+    os.rename(part_filename, filename)
+    if store is not None:
+        store.add(filename, writer.hexdigest())
+    if digests is not None:
+        digests.update(get_digests([filename], {filename: writer}))
+    return size[0]
+
+def get_download_link(layer, formats=SUPPORTED_FORMATS):
+    """Returns the format and the link the data of layer is downloaded from,
+       the first of formats it is available in, or (None, None).
+    """
     # download_links is originally a list of lists, each item looks like:
     # ['zip', 'Zipped Shapefile', 'http://...//'], this operation
     # transforms it into a simple dict, with items like:
@@ -74,68 +640,58 @@ def download_layer(layer, url,  dest_dir, username=None, password=None):
     download_links = dict([ (a, c) for a, b, c in layer['download_links']])
 
     # Find out the appropiate download format for this layer
-    for f in SUPPORTED_FORMATS:
+    for f in formats:
         if f in download_links:
-            download_format = f
-            break
-    else:
+            return f, download_links[f]
+    return None, None
+
+def download_layer(layer, url,  dest_dir, username=None, password=None,
+                   chunk_size=CHUNK_SIZE, session=None, manifest=None,
+                   sync=False, ranges=1, min_range_size=RANGE_MIN_SIZE,
+                   pretty_xml=True, harvested_metadata=False, report=None,
+                   store=None, formats=SUPPORTED_FORMATS):
+    """Downloads the data, metadata and style of a layer into dest_dir. The
+       data is downloaded in the first of formats the layer has.
+
+       Every part that is written is recorded in the manifest, if one is
+       given, see fetch_part for how it is used to avoid transferring parts
+       again. With harvested_metadata, metadata that the manifest has as
+       complete is never requested, because harvest_metadata just wrote it.
+       The time and bytes of every part are measured in report, if given,
+       and the files are added to the BlobStore store, if given.
+       Returns True if any part was downloaded.
+    """
+    if session is None:
+        session = get_session(username, password)
+
+    changed = False
+
+    download_format, download_link = get_download_link(layer, formats)
+    if download_format is None:
         msg = 'Only "%s" are supported for the extract, available formats for "%s" are: "%s"' % (
-                                         ', '.join(SUPPORTED_FORMATS),
+                                         ', '.join(formats),
                                          layer['name'],
-                                         ', '.join(download_links.keys()))
+                                         ', '.join([a for a, b, c in layer['download_links']]))
         log.error(msg)
         raise RuntimeError(msg)
 
-    download_link = download_links[download_format]
     log.debug('Download link for this layer is "%s"' % download_link)
 
+    layer_filename = get_layer_filename(layer, dest_dir)
+    base_filename, extension = os.path.splitext(layer_filename)
+
     try:
-        # Download the file
+        # The body is streamed to disk so large files never have to fit in memory.
         log.debug('Starting data download for "%s"' % layer['name'])
-        r = requests.get(download_link)
-        log.debug('Finished downloading data for "%s"' % layer['name'])
+        data_files = download_data(session, download_link, layer, layer_filename,
+                                   manifest, sync, chunk_size, ranges, min_range_size,
+                                   report, store)
     except Exception, e:
         log.exception('There was a problem downloading "%s".' % layer['name'])
         raise e
-    else:
-        # FIXME(Ariel): This may be dangerous if file is too large.
-        content = r.content
-
-        if 'content-disposition' not in r.headers:
-            msg = ('Layer "%s" did not have a valid download link "%s"' %
-                    (layer['name'], download_link))
-            log.error(msg)
-            raise RuntimeError(msg)
-
-        filename = layer['name']
-
-        # Strip out the 'geonode:' if it exists
-        if ':' in filename:
-            filename = layer['name'].split(':')[1]
-
-        layer_filename = os.path.join(dest_dir, filename)
-        with open(layer_filename, 'wb') as layer_file:
-            layer_file.write(content)
-            log.debug('Saved data from "%s" as "%s"' % (layer['name'], layer_filename))
 
-
-    base_filename, extension = os.path.splitext(layer_filename)
-
-    # If this file a zipfile, unpack all files with the same base_filename
-    # and remove the downloaded zip
-    if zipfile.is_zipfile(layer_filename):
-        log.debug('Layer "%s" is zipped, unpacking now' % layer_filename)
-        # Create a ZipFile object
-        z = zipfile.ZipFile(layer_filename)
-        for f in z.namelist():
-            log.debug('Found "%s" in "%s"' % (f, layer_filename))
-            _, extension = os.path.splitext(f)
-            filename = base_filename + extension
-            log.debug('Saving "%s" to "%s"' % (f, filename))
-            z.extract(f, dest_dir)
-            os.rename(os.path.join(dest_dir, f), filename)
-        log.debug('Removing "%s" because it is not needed anymore' % layer_filename)
-        os.remove(layer_filename)
+    if data_files is not None:
+        changed = True
 
     # metadata_links is originally a list of lists, each item looks like:
     # ['text/xml', 'TC211', 'http://...//'], this operation
@@ -145,60 +701,670 @@ def download_layer(layer, url,  dest_dir, username=None, password=None):
     metadata_link = metadata_links['TC211']
 
     metadata_filename = base_filename + '.xml'
+    if (harvested_metadata and manifest is not None and
+            manifest.is_complete(layer['name'], 'metadata')):
+        log.debug('The metadata of "%s" was harvested in bulk' % layer['name'])
+        r = None
+    else:
+        with measure(report, layer['name'], 'metadata', metadata_link) as record:
+            try:
+                # Download the file
+                r = fetch_part(session, metadata_link, layer, 'metadata', manifest, sync,
+                               stream=True)
+            except Exception, e:
+                log.error('There was a problem downloading "%s": %s' % (layer['name'], str(e)), e)
+                raise e
+
+            if r is not None:
+                changed = True
+                # The record comes wrapped in the response of the CSW service
+                digests = {}
+                size = download_xml(r, metadata_filename, xmlstream.CSW_ENVELOPE,
+                                    pretty_xml, chunk_size, store, digests)
+                record['bytes'] = size
+                log.debug('Saved metadata from "%s" as "%s"' % (layer['name'], metadata_filename))
+
+                if manifest is not None:
+                    manifest.finish(layer['name'], 'metadata', r, size, [metadata_filename],
+                                    digests)
+
+    # Download the associated style
+    style_url = get_style_url(layer, url)
+    with measure(report, layer['name'], 'style', style_url) as record:
+        r = fetch_part(session, style_url, layer, 'style', manifest, sync, stream=True)
+
+        if r is not None:
+            changed = True
+            style_filename = base_filename + '.sld'
+            digests = {}
+            size = download_xml(r, style_filename, pretty=pretty_xml, chunk_size=chunk_size,
+                                store=store, digests=digests)
+            record['bytes'] = size
+            log.debug('Saved style from "%s" as "%s"' % (layer['name'], style_filename))
+
+            if manifest is not None:
+                manifest.finish(layer['name'], 'style', r, size, [style_filename], digests)
+
+    return changed
+
+
+def split_record_link(link):
+    """Splits a GetRecordById link into the url of the CSW service and the
+       id of the record. The id is None if the link does not have one.
+    """
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(link)
+    params = dict((k.lower(), v) for k, v in urlparse.parse_qsl(query))
+    endpoint = urlparse.urlunsplit((scheme, netloc, path, '', ''))
+    return endpoint, params.get('id')
+
+def get_constraints(ids, max_length=MAX_CONSTRAINT_LENGTH):
+    """Splits ids into groups whose CQL constraint, that selects the records
+       with those ids, is at most max_length long once URL encoded. Yields
+       every group of ids and its constraint.
+    """
+    group = []
+    conditions = []
+    length = 0
+    separator = len(urllib.quote_plus(' OR '))
+    for i in ids:
+        condition = "apiso:Identifier = '%s'" % i.replace("'", "''")
+        condition_length = len(urllib.quote_plus(condition))
+        if group and length + separator + condition_length > max_length:
+            yield group, ' OR '.join(conditions)
+            group = []
+            conditions = []
+            length = 0
+        if group:
+            length += separator
+        group.append(i)
+        conditions.append(condition)
+        length += condition_length
+    if group:
+        yield group, ' OR '.join(conditions)
+
+def get_records(session, endpoint, ids, open_record, finish_record,
+                pretty=True, chunk_size=CHUNK_SIZE):
+    """Requests the ISO metadata records with the given ids from the CSW
+       service at endpoint using GetRecords, following nextRecord if the
+       server splits the results in pages. The records are written with
+       xmlstream.split_records while the responses are downloaded.
+
+       The ids go in the query string, so they are sent in as many requests
+       as it takes to keep it short enough for the server, see
+       get_constraints.
+    """
+    for group, constraint in get_constraints(ids):
+        start = 1
+        while True:
+            params = {'service': 'CSW',
+                      'version': '2.0.2',
+                      'request': 'GetRecords',
+                      'typenames': 'gmd:MD_Metadata',
+                      'namespace': 'xmlns(gmd=http://www.isotc211.org/2005/gmd)',
+                      'outputschema': 'http://www.isotc211.org/2005/gmd',
+                      'elementsetname': 'full',
+                      'resulttype': 'results',
+                      'constraintlanguage': 'CQL_TEXT',
+                      'constraint_language_version': '1.1.0',
+                      'constraint': constraint,
+                      'startposition': start,
+                      'maxrecords': len(group)}
+            r = session.get(endpoint, params=params, stream=True)
+            try:
+                r.raise_for_status()
+                results = xmlstream.split_records(r.iter_content(chunk_size),
+                                                  open_record, finish_record, pretty)
+            finally:
+                r.close()
+
+            next_record = int(results.get('nextRecord') or 0)
+            if next_record <= start:
+                break
+            start = next_record
+
+def harvest_batch(layers, dest_dir, session, manifest, pretty_xml=True,
+                  sync=False, chunk_size=CHUNK_SIZE, report=None, store=None):
+    """Harvests the metadata of a list of layers, see harvest_metadata.
+    """
+    # Group the layers by CSW service and record id
+    services = {}
+    for layer in layers:
+        if not sync and (manifest.is_complete(layer['name'], 'metadata') or
+                         is_layer_done(layer, dest_dir, manifest)):
+            continue
+        metadata_links = dict([ (b, c) for a, b, c in layer['metadata_links']])
+        if 'TC211' not in metadata_links:
+            continue
+        endpoint, record_id = split_record_link(metadata_links['TC211'])
+        if record_id is not None:
+            services.setdefault(endpoint, {})[record_id] = (layer, metadata_links['TC211'])
+
+    for endpoint, records in services.items():
+        written = []
+        pending = []
+
+        def open_record():
+            out = tempfile.NamedTemporaryFile(dir=dest_dir, suffix='.part', delete=False)
+            pending.append(out.name)
+            return HashingWriter(out)
+
+        def finish_record(out, identifier):
+            out.close()
+            pending.remove(out.name)
+            if identifier not in records:
+                log.debug('Ignoring unexpected metadata record "%s"' % identifier)
+                os.remove(out.name)
+                return
+            layer, link = records[identifier]
+            base_filename, extension = os.path.splitext(get_layer_filename(layer, dest_dir))
+            metadata_filename = base_filename + '.xml'
+            manifest.start(layer['name'], 'metadata', link)
+            if os.path.exists(metadata_filename):
+                os.remove(metadata_filename)
+            os.rename(out.name, metadata_filename)
+            if store is not None:
+                store.add(metadata_filename, out.hexdigest())
+            manifest.finish(layer['name'], 'metadata', None,
+                            os.path.getsize(metadata_filename), [metadata_filename],
+                            get_digests([metadata_filename], {metadata_filename: out}))
+            log.debug('Saved metadata from "%s" as "%s"' % (layer['name'], metadata_filename))
+            written.append(identifier)
+            record['bytes'] += os.path.getsize(metadata_filename)
+
+        try:
+            with measure(report, None, 'harvest', endpoint) as record:
+                get_records(session, endpoint, records.keys(), open_record,
+                            finish_record, pretty_xml, chunk_size)
+        except Exception, e:
+            log.exception('Could not harvest metadata from "%s", it will be '
+                          'downloaded layer by layer instead.' % endpoint)
+            for filename in pending:
+                os.remove(filename)
+        log.info('Harvested metadata of %d out of %d layers from "%s"' % (
+                    len(written), len(records), endpoint))
+
+def harvest_metadata(layers, dest_dir, session, manifest, batch_size,
+                     pretty_xml=True, sync=False, chunk_size=CHUNK_SIZE,
+                     report=None, store=None):
+    """Harvests the ISO metadata of layers with CSW GetRecords requests, for
+       batch_size layers at a time, and writes it into the same <name>.xml
+       files and manifest records that download_layer would.
+
+       This is a generator that yields the layers once their batch has been
+       harvested, so it can be put in front of extract_layers. Layers whose
+       record could not be harvested are yielded anyway, download_layer
+       falls back to GetRecordById for them. Every request is measured as a
+       'harvest' in report, if one is given.
+    """
+    layers = iter(layers)
+    while True:
+        batch = list(itertools.islice(layers, batch_size))
+        if not batch:
+            break
+        harvest_batch(batch, dest_dir, session, manifest, pretty_xml, sync,
+                      chunk_size, report, store)
+        for layer in batch:
+            yield layer
+
+def parse_shard(value):
+    """Parses a shard given as 'K/N', the Kth of N, into (K, N).
+
+       Raises ValueError unless 1 <= K <= N.
+    """
+    index, _, count = value.partition('/')
+    index, count = int(index), int(count)
+    if not 1 <= index <= count:
+        raise ValueError('Shard "%s" is not between 1/%d and %d/%d' % (
+                            value, count, count, count))
+    return index, count
+
+def get_shard(layer, count):
+    """Returns the shard, from 1 to count, that the layer belongs to.
+
+       It only depends on the name of the layer, so every host that extracts
+       a shard of the same catalog agrees on it, whatever order the search
+       api returns the layers in.
+    """
+    name = layer['name']
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return int(hashlib.md5(name).hexdigest(), 16) % count + 1
+
+def shard_layers(layers, index, count):
+    """Yields the layers that belong to the shard index of count, see
+       get_shard. Running every shard from 1 to count extracts each layer
+       exactly once.
+    """
+    for layer in layers:
+        if get_shard(layer, count) == index:
+            yield layer
+
+def plan_layers(layers, session, concurrency=planner.CONCURRENCY, manifest=None,
+                sync=False, count_members=False, report=None,
+                formats=SUPPORTED_FORMATS, archive=None):
+    """Reads all the layers and finds out the format, link and size of the
+       data of each one, see planner.get_sizes. Returns the list of plan
+       entries, in the order of layers.
+
+       Layers the manifest has as complete are skipped by extract_layer
+       unless sync is set, so they are marked 'done' and their size is taken
+       to be 0 without asking. So are the layers already in archive, an
+       ArchiveReader, if one is given.
+    """
+    entries = []
+    for layer in layers:
+        download_format, link = get_download_link(layer, formats)
+        entry = {'layer': layer, 'format': download_format, 'link': link}
+        if archive is not None:
+            done = archive.has_layer(layer['name'])
+        else:
+            done = (not sync and manifest is not None and manifest.has_layer(layer['name'])
+                    and manifest.is_layer_complete(layer['name']))
+        if done:
+            entry['done'] = True
+            entry['size'] = 0
+        entries.append(entry)
+    return planner.get_sizes(session, entries, concurrency, count_members, report)
+
+def plan_extraction(layers, dest_dir, session, workers=1, shard=None, sync=False,
+                    formats=SUPPORTED_FORMATS, archive_filename=None):
+    """Finds out the size and number of files of every layer, and measures
+       the throughput with a short sample download, without writing anything.
+       Layers already extracted to dest_dir, or to the archive_filename if
+       one is given, are left out of the totals, unless sync is set. Returns
+       the summary of the plan, see planner.summarize_plan.
+    """
+    manifest = None
+    archive = None
+    if archive_filename is not None:
+        # An empty file is an archive that nothing was added to yet
+        if os.path.exists(archive_filename) and os.path.getsize(archive_filename) > 0:
+            archive = ArchiveReader(archive_filename)
+    else:
+        filename = get_manifest_filename(shard)
+        if os.path.exists(os.path.join(dest_dir, filename)):
+            manifest = Manifest(dest_dir, filename)
+    try:
+        entries = plan_layers(layers, session, max(workers, planner.CONCURRENCY),
+                              manifest, sync, count_members=True, formats=formats,
+                              archive=archive)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        if archive is not None:
+            archive.close()
+
+    pending = [entry for entry in entries if not entry.get('done')]
+    # As many samples as workers, to measure them together, but no more than
+    # MAX_SAMPLES so the dry run stays short
+    samples = min(max(planner.SAMPLES, workers), planner.MAX_SAMPLES)
+    throughput, stream_throughput = planner.measure_throughput(
+        session, pending, min(workers, samples), samples)
+    return planner.summarize_plan(entries, workers, throughput, stream_throughput)
+
+def format_plan(summary):
+    """Returns the summary of a plan as text, to be read by a person.
+    """
+    mb = 1024.0 * 1024.0
+    lines = []
+    lines.append('Layers: %d, %d of them already extracted' % (
+                    summary['layers'], summary['extracted']))
+    size = 'Data: %.1f MB' % (summary['bytes'] / mb)
+    if summary['unknown_sizes']:
+        size += ', and %d layers of unknown size' % summary['unknown_sizes']
+    lines.append(size)
+    files = 'Files: %d' % summary['files']
+    if summary['unknown_files']:
+        files += ', and the contents of %d archives' % summary['unknown_files']
+    lines.append(files)
+    for name, totals in sorted(summary['formats'].items()):
+        lines.append('    %s: %d layers, %.1f MB' % (name, totals['layers'],
+                                                    totals['bytes'] / mb))
+    if summary['unsupported']:
+        lines.append('No supported format: %d layers, %s' % (
+                        len(summary['unsupported']), ', '.join(summary['unsupported'])))
+    if summary['throughput'] is not None:
+        lines.append('Throughput: %.2f MB/s with %d workers, %.2f MB/s per download' % (
+                        summary['throughput'] / mb, summary['workers'],
+                        summary['stream_throughput'] / mb))
+    if summary['eta'] is None:
+        lines.append('Could not measure the throughput, no estimate of the duration')
+    else:
+        lines.append('Estimated duration: %s' % datetime.timedelta(
+                        seconds=int(round(summary['eta']))))
+    return '\n'.join(lines) + '\n'
+
+def archive_layer(layer, url, archive, scratch_dir=None, username=None,
+                  password=None, report=None, **kwargs):
+    """Downloads a layer into a directory of its own inside scratch_dir, and
+       appends its files to archive, see archive.LayerArchive. Extra keyword
+       arguments are passed on to download_layer. Returns True.
+    """
+    layer_dir = tempfile.mkdtemp(prefix='geonode-extract-', dir=scratch_dir)
     try:
-        # Download the file
-        r = requests.get(metadata_link)
-        content = r.content
+        download_layer(layer, url, layer_dir, username, password,
+                       report=report, **kwargs)
+        filenames = [os.path.join(layer_dir, f) for f in os.listdir(layer_dir)]
+        # Its bytes were already counted when they were downloaded
+        with measure(report, layer['name'], 'archive'):
+            archive.add_layer(layer['name'], filenames)
+    finally:
+        shutil.rmtree(layer_dir, ignore_errors=True)
+    return True
+
+def format_verification(results):
+    """Returns the files that did not pass verification and the number of
+       files of every status as text, to be read by a person.
+    """
+    lines = []
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        if result['status'] != verify.OK:
+            lines.append('[%s] %s of %s: %s' % (result['status'], result['file'],
+                                               result['layer'], result['problem']))
+    lines.append('Checked %d files: %s' % (len(results), ', '.join(
+                    ['%d %s' % (counts[status], status) for status in sorted(counts)])))
+    return '\n'.join(lines) + '\n'
+
+def extract_layer(layer, url, dest_dir, username=None, password=None,
+                  manifest=None, sync=False, limiter=None, archive=None,
+                  scratch_dir=None, **kwargs):
+    """Downloads data, metadata and style for a single layer, unless it was
+       already extracted to dest_dir. With sync, layers that were already
+       extracted are checked for changes instead. If an archive is given the
+       layer is added to it instead, see archive_layer. If a limiter is given
+       the download waits until it has room, see scheduler.Limiter. Extra
+       keyword arguments are passed on to download_layer.
+
+       It never raises, instead it returns a dict with the 'name', 'title'
+       and 'status' of the layer. The status is one of 'downloaded', 'failed'
+       or 'skipped'. Failed layers also get the name of the 'exception_type',
+       the 'error' message and the 'traceback' of what went wrong, as text so
+       the frames of the failure are not kept alive.
+    """
+    info = {'name': layer['name'], 'title': layer['title']}
+
+    if not sync and is_layer_done(layer, dest_dir, manifest, archive):
+        info['status'] = 'skipped'
+        return info
+
+    def download():
+        if archive is not None:
+            return archive_layer(layer, url, archive, scratch_dir, username,
+                                 password, **kwargs)
+        return download_layer(layer, url, dest_dir, username, password,
+                              manifest=manifest, sync=sync, **kwargs)
+
+    try:
+        if limiter is None:
+            changed = download()
+        else:
+            with limiter:
+                changed = download()
     except Exception, e:
-        log.error('There was a problem downloading "%s": %s' % (layer['name'], str(e)), e)
-        raise e
+        log.exception('Could not download layer "%s".' % layer['name'])
+        info['status'] = 'failed'
+        info['traceback'] = tb.format_exc()
+        info['exception_type'] = e.__class__.__name__
+        info['error'] = '%s' % e
     else:
-        domcontent = minidom.parseString(content)
-        first = domcontent.firstChild
+        if changed:
+            info['status'] = 'downloaded'
+        else:
+            info['status'] = 'skipped'
 
-        if first._get_tagName() == 'csw:GetRecordByIdResponse':
-            md_node = first.childNodes[1]
-            domcontent.replaceChild(md_node, first)
+    return info
 
-        raw_xml = domcontent.toprettyxml().encode('utf-8')
+def extract_layers(layers, url, dest_dir, username=None, password=None,
+                   workers=1, ignore_errors=False, engine='threads', **kwargs):
+    """Runs extract_layer for every layer using a pool of `workers` threads,
+       or of `workers` greenlets if the engine is 'gevent', see green.py.
+       Extra keyword arguments are passed on to extract_layer.
 
-        with open(metadata_filename, 'wb') as metadata_file:
-            metadata_file.write(raw_xml)
-            log.debug('Saved metadata from "%s" as "%s"' % (layer['name'], metadata_filename))
+       This is a generator, it yields the output of extract_layer in the order
+       the layers finish. When a layer fails and ignore_errors is not set no
+       other layers are started, the ones already in progress are allowed to
+       finish and their results are still yielded.
 
-    # Download the associated style
-    style_data = get_style(layer, url, username, password)
+       Closing the generator before it is exhausted also stops the pool, so
+       callers should always close it when they bail out early.
+    """
+    def stop(info):
+        return info['status'] == 'failed' and not ignore_errors
 
-    xml_style_data = minidom.parseString(style_data)
-    pretty_style_data = xml_style_data.toprettyxml().encode('utf-8')
+    if engine == 'gevent':
+        def process(layer):
+            return extract_layer(layer, url, dest_dir, username, password, **kwargs)
+        results = green.imap_unordered(process, layers, workers, stop)
+        try:
+            for info in results:
+                yield info
+        finally:
+            results.close()
+        return
 
-    style_filename = base_filename + '.sld'
-    with open(style_filename, 'wb') as style_file:
-        style_file.write(pretty_style_data)
-        log.debug('Saved style from "%s" as "%s"' % (layer['name'], style_filename))
+    if workers <= 1:
+        for layer in layers:
+            info = extract_layer(layer, url, dest_dir, username, password, **kwargs)
+            yield info
+            if stop(info):
+                return
+        return
 
+    # The task queue is bounded so layers are pulled from the iterable
+    # only as fast as the workers can process them.
+    tasks = Queue.Queue(maxsize=workers * 2)
+    results = Queue.Queue()
+    abort = threading.Event()
+    done = object()
 
-def get_layer_list(url, query=None, endpoint='/data/search/api'):
-    # Get the list of layers from GeoNode's search api JSON endpoint
+    def feed():
+        try:
+            for layer in layers:
+                while not abort.is_set():
+                    try:
+                        tasks.put(layer, timeout=0.1)
+                    except Queue.Full:
+                        continue
+                    break
+                if abort.is_set():
+                    break
+        except Exception, e:
+            log.exception('Could not get the list of layers to extract.')
+            results.put(sys.exc_info())
+            abort.set()
+        finally:
+            for _ in range(workers):
+                tasks.put(done)
+
+    def work():
+        while True:
+            layer = tasks.get()
+            if layer is done:
+                results.put(done)
+                return
+            # Outstanding layers are discarded once the run is aborted.
+            if abort.is_set():
+                continue
+            info = extract_layer(layer, url, dest_dir, username, password, **kwargs)
+            if stop(info):
+                abort.set()
+            results.put(info)
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for _ in range(workers))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        running = workers
+        while running > 0:
+            # A timeout keeps the main thread responsive to KeyboardInterrupt.
+            try:
+                item = results.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+            if item is done:
+                running -= 1
+            elif isinstance(item, tuple):
+                # The layer iterable itself failed.
+                raise item[0], item[1], item[2]
+            else:
+                yield item
+    finally:
+        # Workers discard whatever is left in the queue once abort is set.
+        abort.set()
+        for thread in threads:
+            thread.join()
+
+def get_layer_page(url, query=None, endpoint='/data/search/api', session=None,
+                   report=None, params=None):
+    # Get one page of the list of layers from GeoNode's search api JSON endpoint
     search_api_endpoint = urlparse.urljoin(url, endpoint)
     log.debug('Retrieving list of layers from "%s"' % search_api_endpoint)
-    payload = {}
+    payload = dict(params or {})
     if query is not None:
         payload['q'] = query
 
-    try:
-        r = requests.get(search_api_endpoint, params=payload)
-    except requests.exceptions.ConnectionError, e:
-        log.exception('Could not connect to %s, are you sure you are connected to the internet?' % search_api_endpoint)
-        raise e
-    data = json.loads(r.text)
+    with measure(report, None, 'catalog', search_api_endpoint) as record:
+        try:
+            r = (session or requests).get(search_api_endpoint, params=payload)
+        except requests.exceptions.ConnectionError, e:
+            log.exception('Could not connect to %s, are you sure you are connected to the internet?' % search_api_endpoint)
+            raise e
+        record['bytes'] = len(r.content)
+        data = json.loads(r.text)
     return data
 
+class LayerList(object):
+    """Lazy list of the layers returned by GeoNode's search api.
+
+       The first page is fetched right away, so the total number of layers
+       is known and connection problems show up before the extraction starts.
+       The rest of the pages are fetched while iterating, always one page
+       ahead in a background thread, so layers can be processed as soon as
+       their page arrives. Iteration stops after `limit` layers without
+       requesting any more pages. Every page is measured in report, if one
+       is given.
+
+       Extra parameters of the search api, like the ones of a
+       filters.LayerFilter, are sent with the query. The next pages are
+       requested with the links the api gives, which carry them along.
+
+       If a CatalogCache is given, the pages are stored in it as they arrive,
+       replacing what it had for url and query, see get_search_key.
+    """
+
+    def __init__(self, url, query=None, limit=None, session=None, report=None,
+                 cache=None, params=None):
+        self.url = url
+        self.limit = limit
+        self.session = session
+        self.report = report
+        self.cache = cache
+        self.first_page = get_layer_page(url, query, session=session, report=report,
+                                         params=params)
+
+        # Number of layers in the catalog and number of layers to be processed
+        self.total = self.first_page['total']
+        self.number = self.total
+        if limit is not None and limit < self.total:
+            self.number = limit
+
+        if cache is not None:
+            self.cache_key = cache.start(url, get_search_key(query, params), self.total)
+
+    def prefetch(self, endpoint):
+        page = {}
+        def fetch():
+            try:
+                page['data'] = get_layer_page(self.url, endpoint=endpoint,
+                                              session=self.session,
+                                              report=self.report)
+            except Exception, e:
+                page['error'] = sys.exc_info()
+        thread = threading.Thread(target=fetch)
+        thread.daemon = True
+        thread.start()
+        return thread, page
+
+    def __iter__(self):
+        count = 0
+        data = self.first_page
+        while True:
+            rows = data['rows']
+            if self.cache is not None:
+                self.cache.add(self.cache_key, count, rows)
+                if len(rows) == 0 or data.get('next') is None:
+                    self.cache.finish(self.cache_key)
+            if len(rows) == 0:
+                break
+
+            if self.limit is not None and count + len(rows) >= self.limit:
+                rows = rows[:self.limit - count]
+                next_page = None
+            else:
+                next_page = data.get('next')
+
+            # Ask for the next page before handing out the rows of this one
+            if next_page is not None:
+                thread, page = self.prefetch(next_page)
+
+            for layer in rows:
+                count += 1
+                yield layer
+
+            if next_page is None:
+                break
+
+            thread.join()
+            if 'error' in page:
+                error = page['error']
+                raise error[0], error[1], error[2]
+            data = page['data']
+
+def get_search_key(query=None, params=None):
+    """What the layers of a search are cached under, the query alone or, if
+       there are other parameters, all of them.
+    """
+    if not params:
+        return query
+    key = dict(params)
+    key['q'] = query
+    return key
+
+def get_layer_list(url, query=None, limit=None, session=None, report=None,
+                   cache=None, ttl=None, params=None):
+    """Returns a LayerList with the layers in url that match query and the
+       other parameters of the search api in params.
+
+       With a cache and a ttl in seconds, the layers come from the cache
+       instead if it has them from less than ttl seconds ago, see
+       CatalogCache.get. Otherwise the catalog is read from the search api
+       and stored in the cache.
+    """
+    if cache is not None and ttl is not None:
+        entry = cache.get(url, get_search_key(query, params), ttl, limit)
+        if entry is not None:
+            log.info('Using the list of layers cached %d seconds ago' % (
+                        time.time() - entry['fetched']))
+            return CachedLayerList(cache, entry, limit)
+    return LayerList(url, query, limit, session, report, cache, params)
+
 def get_data(argv=None):
     # Get the arguments passed or get them from sys
     the_argv = argv or sys.argv[:]
     options, original_args = parser.parse_args(the_argv)
 
+    if options.engine == 'gevent':
+        # Has to happen before any connection is opened or thread started
+        try:
+            green.patch()
+        except RuntimeError, e:
+            parser.error(str(e))
+
     # For each -v passed on the commandline, a lower log.level will be enabled.
     # log.ERROR by default, log.INFO with -vv, etc.
     log.addHandler(logging.StreamHandler())
@@ -206,6 +1372,49 @@ def get_data(argv=None):
 
     start = datetime.datetime.now()
 
+    if options.merge:
+        if options.report is None:
+            parser.error('--merge needs --report FILE to write the merged report to')
+        reports = []
+        for filename in options.merge:
+            with open(filename) as f:
+                reports.append(json.load(f))
+        merged = merge_reports(reports)
+        write_report(merged, options.report)
+        log.info('Merged the reports of %d shards, with %d layers, into "%s"' % (
+                    len(reports), merged['layers'], options.report))
+        return
+
+    if options.archive is not None and os.path.exists(options.archive):
+        # Empty files are fine to write the archive to
+        if os.path.getsize(options.archive) > 0 and not has_index(options.archive):
+            parser.error('--archive "%s" has no index, it was not written by geonode-extract' %
+                         options.archive)
+
+    if options.verify:
+        if options.archive is not None:
+            if not os.path.exists(options.archive) or not os.path.getsize(options.archive):
+                parser.error('--verify found no archive "%s", there is nothing to check' %
+                             options.archive)
+            results = verify.verify_archive(options.archive, options.workers)
+        else:
+            if not verify.get_manifests(options.dest_dir):
+                parser.error('--verify found no manifest in "%s", there is nothing to check' %
+                             options.dest_dir)
+            results = verify.verify_directory(options.dest_dir, options.workers)
+        sys.stdout.write(format_verification(results))
+        if options.report is not None:
+            write_report({'files': len(results), 'results': results}, options.report)
+        if not results:
+            log.error('There were no files to check')
+            sys.exit(1)
+        # Files written before digests were kept can not be checked, but
+        # they are not known to be wrong either.
+        if [result for result in results
+                if result['status'] in (verify.MISSING, verify.CHANGED)]:
+            sys.exit(1)
+        return
+
     args = original_args[1:]
     if len(args) != 1:
         parser.error('Please supply a <geonode_url>, for example: http://demo.geonode.org')
@@ -220,100 +1429,271 @@ def get_data(argv=None):
 
     limit = options.limit
     query = options.query
+    workers = options.workers
+
+    chunk_size = options.chunk_size
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
 
-    output_dir = os.path.abspath(dest_dir)
-    log.info('Getting data from "%s" into "%s"' % (url, output_dir))
+    if workers < 1:
+        parser.error('--workers should be at least 1')
+    if options.ranges < 1:
+        parser.error('--ranges should be at least 1')
+    if chunk_size < 1:
+        parser.error('--chunk-size should be a positive number of bytes')
+    if options.bulk_metadata is not None and options.bulk_metadata < 1:
+        parser.error('--bulk-metadata should be at least 1')
+    if options.retries < 0:
+        parser.error('--retries can not be negative')
+    if options.cache_ttl is not None and options.cache_ttl < 0:
+        parser.error('--cache-ttl can not be negative')
+    if options.backoff <= 0 or options.timeout <= 0:
+        parser.error('--backoff and --timeout should be a positive number of seconds')
+    if options.archive is not None:
+        # Files in the archive are never changed, and there is no directory
+        # of loose files to harvest metadata or link duplicates into.
+        if options.sync or options.dedupe or options.bulk_metadata is not None:
+            parser.error('--archive can not be combined with --sync, --dedupe or --bulk-metadata')
 
-    # Create output directory if it does not exist
-    if not os.path.isdir(output_dir):
-        os.makedirs(dest_dir)
+    formats = SUPPORTED_FORMATS
+    if options.formats is not None:
+        formats = [f.strip() for f in options.formats.split(',') if f.strip()]
+        if not formats or [f for f in formats if f not in SUPPORTED_FORMATS]:
+            parser.error('--formats should be a list of some of %s, like tiff,zip' %
+                         ', '.join(SUPPORTED_FORMATS))
+
+    bbox = None
+    if options.bbox is not None:
+        try:
+            bbox = filters.parse_bbox(options.bbox)
+        except ValueError, e:
+            parser.error('--bbox should be given as MINX,MINY,MAXX,MAXY: %s' % e)
+
+    modified_since = None
+    if options.modified_since is not None:
+        try:
+            modified_since = filters.parse_date(options.modified_since)
+        except ValueError, e:
+            parser.error('--modified-since should be a date: %s' % e)
+
+    names = list(options.names)
+    if options.names_file is not None:
+        try:
+            names.extend(filters.read_names(options.names_file))
+        except IOError, e:
+            parser.error('Could not read --names-file: %s' % e)
+
+    # Only formats that were asked for keep layers out, the default ones
+    # make layers without them fail.
+    layer_filter = filters.LayerFilter(options.layer_type, bbox, modified_since, names,
+                                       options.formats and formats)
+
+    shard = None
+    if options.shard is not None:
+        try:
+            shard = parse_shard(options.shard)
+        except ValueError, e:
+            parser.error('--shard should be given as K/N, like 2/4: %s' % e)
+
+    try:
+        schedule = planner.get_policy(options.schedule)
+    except RuntimeError, e:
+        parser.error(str(e))
 
-    data = get_layer_list(url, query)
-    total = data['total']
+    # Only the report written to a file needs every layer
+    report = Report(shard=options.shard, keep_layers=options.report is not None)
+    for hook in options.report_hooks:
+        try:
+            report.add_hook(load_hook(hook))
+        except (ImportError, AttributeError, RuntimeError), e:
+            parser.error('Could not load the report hook "%s": %s' % (hook, e))
 
-    log.info('Found %s layers, starting extraction' % total)
+    limiter = None
+    if options.adaptive and workers > 1:
+        limiter = Limiter(workers)
 
+    session = get_session(username, password, workers * options.ranges,
+                          options.retries, options.backoff, options.timeout, limiter)
+    download_options = {'session': session, 'limiter': limiter,
+                        'ranges': options.ranges,
+                        'pretty_xml': options.pretty_xml,
+                        'chunk_size': chunk_size, 'report': report,
+                        'formats': formats}
 
-    all_layers = data['rows']
+    # The criteria the search api supports are sent to it, the rest are
+    # checked while the pages arrive.
+    params = layer_filter.get_search_params()
 
-    if 'next' in data:
-        next_list = data['next']
+    cache = None
+    cache_ttl = options.cache_ttl
+    if cache_ttl is not None or options.refresh_catalog:
+        cache = CatalogCache(options.cache_dir)
+        if options.refresh_catalog:
+            cache.invalidate(url, get_search_key(query, params))
+            cache_ttl = None
+
+    # With filters, --limit counts the layers that match them
+    list_limit = limit
+    if layer_filter.is_active():
+        list_limit = None
+    layers = get_layer_list(url, query, list_limit, session=session, report=report,
+                            cache=cache, ttl=cache_ttl, params=params)
+
+    log.info('Found %s layers' % layers.total)
+
+    number = layers.number
+    progress_total = '%d' % number
+    if layer_filter.is_active():
+        layers = layer_filter.select(layers, limit)
+        if limit is not None:
+            number = min(number, limit)
+        if names:
+            number = min(number, len(layer_filter.names))
+        log.info('Processing the layers that match the filters, at most %d' % number)
+        progress_total = '<=%d' % number
     else:
-        next_list = None
+        log.info('Processing %s layers' % number)
+    if shard is not None:
+        layers = shard_layers(layers, *shard)
+        # Hashing spreads the layers evenly, but the exact number is only
+        # known once every page of the catalog has been seen.
+        estimate = (number + shard[1] - 1) // shard[1]
+        log.info('Extracting shard %d of %d, about %d layers' % (shard[0], shard[1], estimate))
+        progress_total = '~%d' % estimate
 
-    while(next_list is not None):
-        new_data = get_layer_list(url, endpoint=next_list)
-        new_layers = new_data['rows']
-        next_list = new_data['next']
+    if options.plan:
+        try:
+            summary = plan_extraction(layers, dest_dir, session, workers, shard,
+                                      options.sync, formats, options.archive)
+        finally:
+            if cache is not None:
+                cache.close()
+        sys.stdout.write(format_plan(summary))
+        if options.report is not None:
+            write_report(summary, options.report)
+        return
 
-        if len(new_layers)==0:
-            break
+    manifest = None
+    archive = None
+    if options.archive is not None:
+        log.info('Getting data from "%s" into "%s"' % (url, os.path.abspath(options.archive)))
+        # The index of the archive keeps track of what was extracted
+        archive = LayerArchive(options.archive)
+        download_options['archive'] = archive
+        download_options['scratch_dir'] = options.scratch_dir
+    else:
+        output_dir = os.path.abspath(dest_dir)
+        log.info('Getting data from "%s" into "%s"' % (url, output_dir))
 
-        all_layers.extend(new_layers)
+        # Create output directory if it does not exist
+        if not os.path.isdir(output_dir):
+            os.makedirs(dest_dir)
 
-    # Since the search API may return paginated results, repeast the process to fetch all layers.
+        # Every shard has a manifest of its own, so hosts sharing a destination
+        # never write to the same database.
+        manifest = Manifest(dest_dir, get_manifest_filename(shard))
+    download_options['manifest'] = manifest
+    download_options['sync'] = options.sync
 
-    layers = all_layers
-    if limit is not None:
-        if limit < len(all_layers):
-            layers = all_layers[:limit]
+    store = None
+    if options.dedupe:
+        if not hasattr(os, 'link'):
+            parser.error('--dedupe needs hard links, which are not available here')
+        store = BlobStore(dest_dir)
+    download_options['store'] = store
 
-    number = len(layers)
-    log.info('Processing %s layers' % number)
-    output = []
-    for i, layer in enumerate(layers):
-        if ':' in layer['name']:
-            name = layer['name'].split(':')[1]
-        else:
-            name = layer['name']
+    timings = None
+    if options.timings is not None:
+        timings = JSONLinesWriter(options.timings)
+        report.add_hook(timings)
 
-        if os.path.exists(os.path.join(dest_dir, name + '.sld')):
-            status = 'skipped'
-        else:
-            try:
-                download_layer(layer, url, dest_dir, username, password)
-            except Exception, e:
-                log.exception('Could not download layer "%s".' % layer['name'])
-                exception_type, error, traceback = sys.exc_info()
-                status = 'failed'
-                if not ignore_errors:
-                    msg = "Stopping process because --ignore-errors was not set and an error was found."
-                    log.error(msg)
-                    sys.exit(-1)
-            else:
-               status = 'downloaded'
+    events = None
+    if options.events is not None:
+        events = JSONLinesWriter(options.events)
 
-        info = {'name': layer['name'], 'title': layer['title'], 'status': status}
-        msg = "[%s] Layer %s (%d/%d)" % (info['status'], info['name'], i+1, number)
-        log.info(msg)
+    if schedule is not planner.catalog_first:
+        # The whole list of layers has to be known before the first one
+        # starts, so the catalog is read and sized up front.
+        log.info('Finding out the size of every layer')
+        plan = plan_layers(layers, session, max(workers, planner.CONCURRENCY),
+                           manifest, options.sync, report=report, formats=formats,
+                           archive=archive)
+        sizes = [entry['size'] for entry in plan if entry['size'] is not None]
+        log.info('Planned %d layers, %d bytes in total, %d of unknown size' % (
+                    len(plan), sum(sizes), len(plan) - len(sizes)))
+        layers = [entry['layer'] for entry in schedule(plan)]
+        progress_total = '%d' % len(layers)
+    if options.bulk_metadata is not None:
+        layers = harvest_metadata(layers, dest_dir, session, manifest,
+                                  options.bulk_metadata, options.pretty_xml,
+                                  options.sync, chunk_size, report, store)
+        download_options['harvested_metadata'] = True
 
-        if status == 'failed':
-           info['traceback'] = traceback
-           info['exception_type'] = exception_type
-           info['error'] = error
+    results = extract_layers(layers, url, dest_dir, username, password,
+                             workers=workers, ignore_errors=ignore_errors,
+                             engine=options.engine, **download_options)
+    try:
+        for i, info in enumerate(results):
+            msg = "[%s] Layer %s (%d/%s)" % (info['status'], info['name'], i+1, progress_total)
+            log.info(msg)
+
+            report.add_result(info)
+            if events is not None:
+                info['finished'] = time.time()
+                events(info)
 
-        output.append(info)
+            if info['status'] == 'failed' and not ignore_errors:
+                msg = "Stopping process because --ignore-errors was not set and an error was found."
+                log.error(msg)
+                sys.exit(-1)
+    finally:
+        # Makes sure no new layers are started and waits for the ones in flight.
+        results.close()
+        if manifest is not None:
+            manifest.close()
+        if archive is not None:
+            archive.close()
+        if cache is not None:
+            cache.close()
+        if timings is not None:
+            timings.close()
+        if events is not None:
+            events.close()
+        if options.report is not None:
+            report.write(options.report)
 
-    downloaded = [dict_['name'] for dict_ in output if dict_['status']=='downloaded']
-    failed = [dict_['name'] for dict_ in output if dict_['status']=='failed']
-    skipped = [dict_['name'] for dict_ in output if dict_['status']=='skipped']
+    summary = report.summary()
+    results = summary['results']
+    processed = sum(results.values())
     finish = datetime.datetime.now()
-    td = finish - start
-    duration = td.microseconds / 1000000 + td.seconds + td.days * 24 * 3600
+    duration = (finish - start).total_seconds()
     duration_rounded = round(duration, 2)
 
-    log.debug("\nDetailed report of failures:")
-    for dict_ in output:
-        if dict_['status'] == 'failed':
-            log.debug(dict_['name'])
-            tb.print_exception(dict_['exception_type'],
-                                      dict_['error'],
-                                      dict_['traceback'])
+    # The tracebacks were logged as the layers failed, and are in the
+    # --events file if there is one.
+    log.debug("\nLayers that failed:")
+    for name in summary['failed']:
+        log.debug(name)
+    unlisted = results.get('failed', 0) - len(summary['failed'])
+    if unlisted > 0:
+        log.debug('and %d more, see --events' % unlisted)
 
     log.info("Finished processing %d layers in %s seconds." % (
-                              len(output), duration_rounded))
-    log.info("%d Downloaded layers" % len(downloaded))
-    log.info("%d Failed layers" % len(failed))
-    log.info("%d Skipped layers" % len(skipped))
-    if len(output) > 0:
-        log.info("%f seconds per layer" % (duration * 1.0 / len(output)))
+                              processed, duration_rounded))
+    log.info("%d Downloaded layers" % results.get('downloaded', 0))
+    log.info("%d Failed layers" % results.get('failed', 0))
+    log.info("%d Skipped layers" % results.get('skipped', 0))
+    if processed > 0:
+        log.info("%f seconds per layer" % (duration * 1.0 / processed))
+    if store is not None:
+        freed = store.prune()
+        log.info("%d duplicate files linked, saving %d bytes, %d bytes of old files freed" % (
+                    store.duplicates, store.saved, freed))
+
+    for phase in PHASES:
+        if phase in summary['phases']:
+            totals = summary['phases'][phase]
+            log.info("%s: %d times, %.2f seconds, %d bytes" % (
+                         phase, totals['count'], totals['seconds'], totals['bytes']))
+    for layer in summary['slowest']:
+        log.debug("Slow layer %s: %.2f seconds" % (layer['layer'], layer['seconds']))
@@ -0,0 +1,189 @@
+"""Selects the layers of a catalog to extract.
+
+   Criteria the search api of GeoNode understands, the type of layer and a
+   bounding box, are sent along with the query so the server only returns
+   matching layers. Every criterion is also checked on the layers as the
+   pages arrive, for the ones the api does not support, like the date of the
+   last change, a list of names or the formats of the data, and for servers
+   that ignore some of the parameters.
+
+   Layers whose rows do not have the field a criterion needs, like servers
+   that do not give the bounding box of their layers, are kept.
+"""
+from __future__ import with_statement
+
+import itertools
+import logging
+
+log = logging.getLogger("geonode-extract")
+
+TYPES = ['vector', 'raster']
+
+# Formats of the data of raster layers, all the others are vector layers
+RASTER_FORMATS = ['tiff']
+
+# How GeoServer calls the store of each type of layer
+STORE_TYPES = {'dataStore': 'vector', 'coverageStore': 'raster'}
+
+# Fields of the rows of the search api the criteria are checked on, they
+# have to be kept by the catalog cache as well.
+DATE_FIELDS = ['last_modified', 'date']
+FIELDS = ['storeType', 'bbox'] + DATE_FIELDS
+
+
+def parse_bbox(value):
+    """Parses a bounding box given as 'minx,miny,maxx,maxy'.
+
+       Raises ValueError if it is not four numbers with the minimums first.
+    """
+    bbox = [float(v) for v in value.split(',')]
+    if len(bbox) != 4:
+        raise ValueError('"%s" does not have four numbers' % value)
+    if bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+        raise ValueError('"%s" has its minimums after its maximums' % value)
+    return bbox
+
+
+def parse_date(value):
+    """Turns a date, or a date and time, into a string that sorts like the
+       time it stands for, like '2013-05-01T00:00:00'. Time zones are ignored.
+
+       Raises ValueError if it does not look like an ISO 8601 date.
+    """
+    value = value.strip().replace(' ', 'T')
+    date, _, time = value.partition('T')
+    parts = date.split('-')
+    if len(parts) != 3 or not all([p.isdigit() for p in parts]):
+        raise ValueError('"%s" is not a date like 2013-05-01' % value)
+    time = time[:8] + '00:00:00'[len(time[:8]):]
+    return '%04d-%02d-%02dT%s' % (int(parts[0]), int(parts[1]), int(parts[2]), time)
+
+
+def read_names(filename):
+    """Reads the names of layers in filename, one per line. Empty lines and
+       lines that start with # are skipped.
+    """
+    names = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                names.append(line)
+    return names
+
+
+def get_short_name(name):
+    # Names in the catalog have the workspace in front, like 'geonode:roads'
+    return name.split(':')[-1]
+
+
+def get_layer_type(layer):
+    """Returns 'vector' or 'raster' for a row of the search api, from the
+       type of its store or else from the formats it can be downloaded in.
+    """
+    store_type = layer.get('storeType')
+    if store_type in STORE_TYPES:
+        return STORE_TYPES[store_type]
+    formats = [link[0] for link in layer.get('download_links', [])]
+    for f in RASTER_FORMATS:
+        if f in formats:
+            return 'raster'
+    return 'vector'
+
+
+def get_layer_bbox(layer):
+    """Returns the bounding box of a row of the search api as [minx, miny,
+       maxx, maxy], or None if it does not have one.
+    """
+    bbox = layer.get('bbox')
+    try:
+        if isinstance(bbox, dict):
+            return [float(bbox[k]) for k in ['minx', 'miny', 'maxx', 'maxy']]
+        if isinstance(bbox, (list, tuple)) and len(bbox) == 4:
+            return [float(v) for v in bbox]
+    except (KeyError, TypeError, ValueError):
+        pass
+    return None
+
+
+def get_layer_date(layer):
+    for field in DATE_FIELDS:
+        if layer.get(field):
+            try:
+                return parse_date(layer[field])
+            except ValueError:
+                log.debug('Could not read the date "%s" of "%s"' % (
+                            layer[field], layer['name']))
+    return None
+
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+class LayerFilter(object):
+    """Criteria layers have to meet to be extracted, all of them at the same
+       time. Each one is None, or empty, if it does not apply.
+
+       layer_type is 'vector' or 'raster', bbox is [minx, miny, maxx, maxy]
+       and the layers have to intersect it, modified_since is the string
+       given by parse_date, names are the names of the layers, with or
+       without the workspace, and formats are the formats layers have to be
+       available in.
+    """
+
+    def __init__(self, layer_type=None, bbox=None, modified_since=None,
+                 names=None, formats=None):
+        self.layer_type = layer_type
+        self.bbox = bbox
+        self.modified_since = modified_since
+        self.names = set([get_short_name(name) for name in names or []])
+        self.formats = list(formats or [])
+
+    def get_search_params(self):
+        """Returns the parameters of the search api that select the layers
+           the server can filter by itself.
+        """
+        params = {}
+        if self.layer_type is not None:
+            params['type'] = self.layer_type
+        if self.bbox is not None:
+            params['bbox'] = ','.join(['%s' % v for v in self.bbox])
+        return params
+
+    def is_active(self):
+        return bool(self.layer_type or self.bbox or self.modified_since or
+                    self.names or self.formats)
+
+    def matches(self, layer):
+        if self.names and get_short_name(layer['name']) not in self.names:
+            return False
+        if self.layer_type is not None and get_layer_type(layer) != self.layer_type:
+            return False
+        if self.formats:
+            formats = [link[0] for link in layer.get('download_links', [])]
+            if not [f for f in self.formats if f in formats]:
+                return False
+        if self.bbox is not None:
+            bbox = get_layer_bbox(layer)
+            if bbox is not None and not intersects(bbox, self.bbox):
+                return False
+        if self.modified_since is not None:
+            date = get_layer_date(layer)
+            if date is not None and date < self.modified_since:
+                return False
+        return True
+
+    def select(self, layers, limit=None):
+        """Yields the layers that match, up to limit of them. With a list of
+           names, it stops reading layers once all of them were found.
+        """
+        found = set()
+        selected = (layer for layer in layers if self.matches(layer))
+        for layer in itertools.islice(selected, limit):
+            yield layer
+            if self.names:
+                found.add(get_short_name(layer['name']))
+                if found == self.names:
+                    log.debug('Found all the %d layers asked for' % len(found))
+                    return
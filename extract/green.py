@@ -0,0 +1,87 @@
+"""Coroutine based extraction engine on top of gevent.
+
+   Every layer is processed in a greenlet, a coroutine that gives way to the
+   others whenever it waits for the network, instead of in a thread of its
+   own. Greenlets are cheap enough to keep thousands of requests in flight,
+   which is what large federated catalogs with many small layers need.
+
+   gevent is an optional dependency, this module can be imported without it
+   but patch and imap_unordered raise RuntimeError if it is not installed.
+"""
+import sys
+
+try:
+    import gevent
+    from gevent import monkey
+    from gevent.event import Event
+    from gevent.pool import Pool
+    from gevent.queue import Queue
+except ImportError:
+    gevent = None
+
+
+def check():
+    if gevent is None:
+        raise RuntimeError('The gevent engine needs gevent, install it with '
+                           '"pip install gevent"')
+
+
+def patch():
+    """Makes the standard library cooperative, so requests, threads and
+       locks used by the extraction give way to other greenlets. It has to
+       be called before any connection is opened or thread started.
+    """
+    check()
+    monkey.patch_all()
+
+
+def imap_unordered(function, items, concurrency, stop=None):
+    """Calls function for each of items in its own greenlet, with at most
+       `concurrency` greenlets running at the same time.
+
+       This is a generator that yields the results in the order they finish.
+       Once stop(result) is true for a result no more items are started, the
+       ones in progress are allowed to finish and their results are still
+       yielded. Closing the generator early has the same effect.
+    """
+    check()
+    group = Pool(concurrency)
+    results = Queue()
+    abort = Event()
+    done = object()
+
+    def run(item):
+        # Outstanding items are discarded once the run is aborted.
+        if abort.is_set():
+            return
+        result = function(item)
+        if stop is not None and stop(result):
+            abort.set()
+        results.put(result)
+
+    def feed():
+        try:
+            for item in items:
+                if abort.is_set():
+                    break
+                # Blocks while the pool is full
+                group.spawn(run, item)
+        except Exception, e:
+            results.put(sys.exc_info())
+            abort.set()
+        group.join()
+        results.put(done)
+
+    feeder = gevent.spawn(feed)
+    try:
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            elif isinstance(item, tuple):
+                # The iterable of items itself failed.
+                raise item[0], item[1], item[2]
+            yield item
+    finally:
+        abort.set()
+        feeder.join()
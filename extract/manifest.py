@@ -0,0 +1,198 @@
+from __future__ import with_statement
+
+import os
+import json
+import sqlite3
+import datetime
+import threading
+
+MANIFEST_FILENAME = '.geonode-extract.db'
+
+# Every layer is made of these parts, downloaded in this order
+PARTS = ['data', 'metadata', 'style']
+
+
+def get_manifest_filename(shard=None):
+    """Name of the manifest of an extraction, or of the shard (K, N) of one.
+    """
+    if shard is None:
+        return MANIFEST_FILENAME
+    base, extension = os.path.splitext(MANIFEST_FILENAME)
+    return '%s-%d-of-%d%s' % (base, shard[0], shard[1], extension)
+
+
+class Manifest(object):
+    """Keeps track of what was extracted into a destination directory.
+
+       For each part of each layer it records where it came from, the ETag
+       and Last-Modified headers it was served with, its size in bytes, the
+       files it was written to, with the SHA-256 digest and size of each one,
+       and whether it was completely written. It is stored as a SQLite
+       database inside the destination directory, and it is safe to share
+       between threads.
+    """
+
+    def __init__(self, dest_dir, filename=MANIFEST_FILENAME):
+        self.dest_dir = dest_dir
+        self.path = os.path.join(dest_dir, filename)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS parts ('
+                            ' layer TEXT NOT NULL,'
+                            ' part TEXT NOT NULL,'
+                            ' url TEXT,'
+                            ' etag TEXT,'
+                            ' last_modified TEXT,'
+                            ' accept_ranges TEXT,'
+                            ' size INTEGER,'
+                            ' files TEXT,'
+                            ' complete INTEGER NOT NULL DEFAULT 0,'
+                            ' updated TEXT,'
+                            ' digests TEXT,'
+                            ' PRIMARY KEY (layer, part))')
+            # Manifests written before digests were kept do not have them
+            columns = [row['name'] for row in
+                       self.db.execute('PRAGMA table_info(parts)').fetchall()]
+            if 'digests' not in columns:
+                self.db.execute('ALTER TABLE parts ADD COLUMN digests TEXT')
+            self.db.commit()
+
+    def get(self, layer, part):
+        """Returns the record of a part of a layer as a dict, or None.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT * FROM parts WHERE layer=? AND part=?',
+                                  (layer, part)).fetchone()
+        if row is None:
+            return None
+        return self.load(row)
+
+    def load(self, row):
+        record = dict(zip(row.keys(), row))
+        record['files'] = json.loads(record['files'] or '[]')
+        record['digests'] = json.loads(record['digests'] or '{}')
+        record['complete'] = bool(record['complete'])
+        return record
+
+    def records(self):
+        """Yields the record of every part that was completely written.
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM parts WHERE complete=1'
+                                   ' ORDER BY layer, part').fetchall()
+        for row in rows:
+            yield self.load(row)
+
+    def has_layer(self, layer):
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM parts WHERE layer=? LIMIT 1',
+                                  (layer,)).fetchone()
+        return row is not None
+
+    def is_complete(self, layer, part):
+        """A part is complete if it was fully written and its files are still there.
+        """
+        record = self.get(layer, part)
+        if record is None or not record['complete']:
+            return False
+        for filename in record['files']:
+            if not os.path.exists(os.path.join(self.dest_dir, filename)):
+                return False
+        return True
+
+    def is_layer_complete(self, layer):
+        for part in PARTS:
+            if not self.is_complete(layer, part):
+                return False
+        return True
+
+    def conditional_headers(self, layer, part):
+        """Headers that make the server skip the body if the part did not change.
+        """
+        headers = {}
+        if not self.is_complete(layer, part):
+            return headers
+        record = self.get(layer, part)
+        if record['etag']:
+            headers['If-None-Match'] = record['etag']
+        if record['last_modified']:
+            headers['If-Modified-Since'] = record['last_modified']
+        return headers
+
+    def start(self, layer, part, url, response=None):
+        """Marks a part as being written, until finish is called for it.
+
+           The validators and Accept-Ranges header of the response, if there
+           is one, are kept so an interrupted download can be resumed later on.
+        """
+        headers = {}
+        accept_ranges = None
+        if response is not None:
+            headers = response.headers
+            accept_ranges = headers.get('accept-ranges')
+            if response.status_code == 206:
+                accept_ranges = 'bytes'
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO parts'
+                            ' (layer, part, url, etag, last_modified,'
+                            '  accept_ranges, complete, updated)'
+                            ' VALUES (?, ?, ?, ?, ?, ?, 0, ?)',
+                            (layer, part, url,
+                             headers.get('etag'),
+                             headers.get('last-modified'),
+                             accept_ranges, self.now()))
+            self.db.commit()
+
+    def resume_headers(self, layer, part, url, offset):
+        """Headers to request the rest of a part that was interrupted after
+           offset bytes, or None if it can not be resumed.
+
+           That is only possible if the server advertised byte ranges for it
+           and gave a validator for If-Range, so the bytes that are appended
+           are known to come from the same version of the file.
+        """
+        record = self.get(layer, part)
+        if record is None or record['complete'] or record['url'] != url:
+            return None
+        if record['accept_ranges'] != 'bytes':
+            return None
+        validator = record['etag'] or record['last_modified']
+        if not validator:
+            return None
+        return {'Range': 'bytes=%d-' % offset, 'If-Range': validator}
+
+    def finish(self, layer, part, response, size, files, digests=None):
+        """Records a part as complete, with the headers of the response it
+           came from, the number of bytes received and the files written.
+           Parts that did not come from a response of their own, like
+           harvested metadata, are recorded without validators.
+
+           digests maps the files to dicts with their 'sha256' digest and
+           their 'size', see verify.py.
+        """
+        headers = {}
+        if response is not None:
+            headers = response.headers
+        files = [os.path.relpath(f, self.dest_dir) for f in files]
+        digests = dict((os.path.relpath(f, self.dest_dir), d)
+                       for f, d in (digests or {}).items())
+        with self.lock:
+            self.db.execute('UPDATE parts SET etag=?, last_modified=?, size=?,'
+                            ' files=?, complete=1, updated=?, digests=?'
+                            ' WHERE layer=? AND part=?',
+                            (headers.get('etag'),
+                             headers.get('last-modified'),
+                             size, json.dumps(files), self.now(),
+                             json.dumps(digests, sort_keys=True),
+                             layer, part))
+            self.db.commit()
+
+    def now(self):
+        return datetime.datetime.utcnow().isoformat()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
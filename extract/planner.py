@@ -0,0 +1,330 @@
+"""Plans the order layers are extracted in from the size of their data.
+
+   When layers are extracted in the order of the catalog, a large file that
+   comes up last keeps one worker busy long after the others ran out of
+   work. Asking for the size of every file first, with concurrent HEAD
+   requests, lets the largest files start first instead, so all the workers
+   finish at about the same time.
+
+   A scheduling policy is a function that takes the list of plan entries,
+   dicts with the 'layer', the 'format' and 'link' of its data and its
+   'size' in bytes, or None if the server did not say, and returns them in
+   the order they should be extracted.
+
+   The same plan, with a short sample download to measure the throughput,
+   gives the size and an estimate of the duration of an extraction before it
+   starts, see summarize_plan.
+"""
+from __future__ import with_statement
+
+import Queue
+import logging
+import time
+import threading
+
+from extract import zipstream
+from extract.report import load_hook, measure
+
+log = logging.getLogger("geonode-extract")
+
+# Number of HEAD requests sent at the same time
+CONCURRENCY = 8
+
+# Servers that do not implement HEAD answer with one of these
+HEAD_NOT_SUPPORTED = [405, 501]
+
+# Bytes read from the end of a zip archive to count its members, enough
+# for the end of central directory records unless there is a long comment
+ZIP_TAIL_SIZE = 8 * 1024
+
+# Number of files downloaded in part to measure the throughput, and how
+# many bytes of each
+SAMPLES = 4
+SAMPLE_SIZE = 2 * 1024 * 1024
+
+# Most files sampled, and at the same time, however many workers there are
+MAX_SAMPLES = 2 * SAMPLES
+
+# Requests needed to extract a layer: data, metadata and style
+REQUESTS_PER_LAYER = 3
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_size(session, link):
+    """Returns the size in bytes of the file at link, without downloading
+       it, or None if the server does not say.
+    """
+    r = session.head(link, allow_redirects=True)
+    if r.status_code in HEAD_NOT_SUPPORTED:
+        # Only the headers are read, the body is dropped with the connection
+        r = session.get(link, stream=True)
+        r.close()
+    if r.status_code != 200 or 'content-encoding' in r.headers:
+        return None
+    length = r.headers.get('content-length')
+    if length is None or not length.isdigit():
+        return None
+    return int(length)
+
+
+def get_member_count(session, link, size):
+    """Returns the number of members of the zip archive at link, which is
+       size bytes long, reading only its last bytes, or None if the server
+       does not serve byte ranges.
+    """
+    start = max(0, size - ZIP_TAIL_SIZE)
+    r = session.get(link, headers={'Range': 'bytes=%d-' % start}, stream=True)
+    try:
+        if r.status_code != 206:
+            return None
+        return zipstream.count_members(r.raw.read(ZIP_TAIL_SIZE))
+    finally:
+        r.close()
+
+
+def run_concurrently(function, items, concurrency):
+    """Calls function with every item, from `concurrency` threads, or
+       greenlets once gevent patched threading.
+    """
+    tasks = Queue.Queue()
+    for item in items:
+        tasks.put(item)
+
+    def work():
+        while True:
+            try:
+                item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            function(item)
+
+    threads = [threading.Thread(target=work) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def get_sizes(session, entries, concurrency=CONCURRENCY, count_members=False,
+              report=None):
+    """Sets the 'size' of every plan entry that has a link and no size yet,
+       sending up to `concurrency` requests at the same time. Entries whose
+       size could not be found out are left with None. The time the request
+       took is kept as the 'latency' of the entry.
+
+       With count_members the 'members' of zip archives are counted too, see
+       get_member_count.
+    """
+    pending = []
+    for entry in entries:
+        entry.setdefault('size', None)
+        if entry['link'] is not None and entry['size'] is None:
+            pending.append(entry)
+
+    def plan(entry):
+        try:
+            with measure(report, entry['layer']['name'], 'plan', entry['link']) as record:
+                started = time.time()
+                entry['size'] = get_size(session, entry['link'])
+                entry['latency'] = time.time() - started
+                if count_members and entry['format'] == 'zip' and entry['size']:
+                    entry['members'] = get_member_count(session, entry['link'],
+                                                        entry['size'])
+        except Exception, e:
+            log.debug('Could not get the size of "%s": %s' % (entry['link'], e))
+
+    run_concurrently(plan, pending, concurrency)
+    return entries
+
+
+def measure_throughput(session, entries, concurrency=1, samples=SAMPLES,
+                       sample_size=SAMPLE_SIZE, chunk_size=CHUNK_SIZE):
+    """Downloads the first sample_size bytes of the largest files of the
+       plan, `concurrency` at a time, and throws them away.
+
+       Returns the throughput of the downloads together and the one of a
+       single download, in bytes per second, or (None, None) if nothing could
+       be downloaded. The time until the response starts is left out, it is
+       accounted for by the latency of the plan.
+    """
+    candidates = [e for e in entries if e['link'] is not None and e['size']]
+    candidates.sort(key=lambda e: e['size'], reverse=True)
+    transfers = []
+    lock = threading.Lock()
+
+    def sample(entry):
+        try:
+            r = session.get(entry['link'], stream=True)
+            try:
+                started = time.time()
+                received = 0
+                for data in r.iter_content(chunk_size):
+                    received += len(data)
+                    if received >= sample_size:
+                        break
+                finished = time.time()
+            finally:
+                r.close()
+        except Exception, e:
+            log.debug('Could not download a sample of "%s": %s' % (entry['link'], e))
+            return
+        with lock:
+            transfers.append((received, started, finished))
+
+    run_concurrently(sample, candidates[:samples], concurrency)
+
+    received = sum([t[0] for t in transfers])
+    if not received:
+        return None, None
+    elapsed = max([t[2] for t in transfers]) - min([t[1] for t in transfers])
+    busy = sum([t[2] - t[1] for t in transfers])
+    if elapsed <= 0 or busy <= 0:
+        return None, None
+    return received / elapsed, received / busy
+
+
+def summarize_plan(entries, workers=1, throughput=None, stream_throughput=None):
+    """Returns the totals of a plan as a dict that can be written as JSON.
+
+       'bytes' and 'files' add up the layers left to extract, the ones whose
+       size or number of files is unknown are counted in 'unknown_sizes' and
+       'unknown_files'. 'formats' has the number of layers and bytes of each
+       format, and 'unsupported' the names of the layers with no supported
+       format.
+
+       'eta' is the estimated duration in seconds, if the throughput was
+       measured: the time to transfer every byte, plus the latency of every
+       request spread over the workers, but never less than the time to
+       transfer the largest file on its own.
+    """
+    pending = [e for e in entries if not e.get('done')]
+    formats = {}
+    unsupported = []
+    total = 0
+    files = 0
+    unknown_sizes = 0
+    unknown_files = 0
+    for entry in pending:
+        if entry['link'] is None:
+            unsupported.append(entry['layer']['name'])
+            continue
+        totals = formats.setdefault(entry['format'], {'layers': 0, 'bytes': 0})
+        totals['layers'] += 1
+        if entry['size'] is None:
+            unknown_sizes += 1
+        else:
+            totals['bytes'] += entry['size']
+            total += entry['size']
+        # The metadata and the style, next to the data
+        files += 2
+        if entry['format'] != 'zip':
+            files += 1
+        elif entry.get('members') is not None:
+            files += entry['members']
+        else:
+            unknown_files += 1
+
+    latencies = [e['latency'] for e in pending if 'latency' in e]
+    latency = None
+    if latencies:
+        latency = sum(latencies) / len(latencies)
+
+    eta = None
+    downloadable = len(pending) - len(unsupported)
+    if not downloadable:
+        eta = 0.0
+    elif throughput and stream_throughput:
+        known = downloadable - unknown_sizes
+        estimated = total
+        if known:
+            estimated += unknown_sizes * total / known
+        eta = estimated / throughput
+        if latency is not None:
+            eta += downloadable * REQUESTS_PER_LAYER * latency / workers
+        sizes = [e['size'] for e in pending if e['size']]
+        if sizes:
+            eta = max(eta, max(sizes) / stream_throughput)
+
+    return {'layers': len(entries),
+            'extracted': len(entries) - len(pending),
+            'bytes': total,
+            'unknown_sizes': unknown_sizes,
+            'files': files,
+            'unknown_files': unknown_files,
+            'formats': formats,
+            'unsupported': unsupported,
+            'latency': latency,
+            'throughput': throughput,
+            'stream_throughput': stream_throughput,
+            'workers': workers,
+            'eta': eta}
+
+
+def get_sort_size(entries):
+    """Returns a function that gives the size to sort an entry by. Entries
+       of unknown size count as the average of the known ones.
+    """
+    known = [e['size'] for e in entries if e['size'] is not None]
+    average = 0
+    if known:
+        average = sum(known) / len(known)
+
+    def size(entry):
+        if entry['size'] is None:
+            return average
+        return entry['size']
+    return size
+
+
+def catalog_first(entries):
+    """Keeps the order of the catalog.
+    """
+    return list(entries)
+
+
+def largest_first(entries):
+    """Starts with the largest files, so no large file is left for the end
+       while the other workers sit idle. Layers without a supported format
+       go last, they fail right away.
+    """
+    size = get_sort_size(entries)
+    downloadable = [e for e in entries if e['link'] is not None]
+    rest = [e for e in entries if e['link'] is None]
+    # sorted is stable, layers of the same size keep the catalog order
+    return sorted(downloadable, key=size, reverse=True) + rest
+
+
+def smallest_first(entries):
+    """Starts with the smallest files, to have as many layers as possible
+       as soon as possible.
+    """
+    size = get_sort_size(entries)
+    downloadable = [e for e in entries if e['link'] is not None]
+    rest = [e for e in entries if e['link'] is None]
+    return sorted(downloadable, key=size) + rest
+
+
+POLICIES = {
+    'catalog': catalog_first,
+    'largest': largest_first,
+    'smallest': smallest_first,
+}
+
+
+def get_policy(name):
+    """Returns the scheduling policy called name in POLICIES, or the function
+       given as 'package.module:function'.
+
+       Raises RuntimeError if there is no such policy.
+    """
+    if name in POLICIES:
+        return POLICIES[name]
+    if ':' not in name:
+        raise RuntimeError('Unknown scheduling policy "%s", use one of %s or '
+                           '"module:function"' % (name, ', '.join(sorted(POLICIES))))
+    try:
+        return load_hook(name)
+    except (ImportError, AttributeError), e:
+        raise RuntimeError('Could not load the scheduling policy "%s": %s' % (name, e))
@@ -0,0 +1,295 @@
+"""Timings and byte counts of every phase of an extraction.
+
+   The phases are:
+
+    * catalog, a page of the search api
+    * plan, finding out the size of the data of a layer, see planner.py
+    * harvest, a batch of metadata records fetched with CSW GetRecords
+    * transfer, the download of the data of a layer, zip archives that are
+      unpacked while they download are unpacked in this phase
+    * unzip, unpacking an archive that was written to disk first
+    * metadata, the download of the metadata of a layer
+    * style, the download of the style of a layer
+    * archive, adding the files of a layer to the --archive
+"""
+from __future__ import with_statement
+
+import sys
+import time
+import json
+import heapq
+import logging
+import urlparse
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger("geonode-extract")
+
+PHASES = ['catalog', 'plan', 'harvest', 'transfer', 'unzip', 'metadata', 'style',
+          'archive']
+
+# Number of layers listed as the slowest ones in the summary
+SLOWEST = 10
+
+# Number of failed layers listed by name, the rest are only counted
+FAILED = 100
+
+MB = 1024.0 * 1024.0
+
+
+class Report(object):
+    """Collects the measurements of an extraction and adds them up per
+       phase, per layer and per host. It is safe to share between threads.
+
+       Every measurement is a dict with the 'layer' it belongs to, None for
+       catalog pages and harvests, the 'phase', the 'host' it was downloaded
+       from, when it 'started', how many 'seconds' it took, the 'bytes'
+       received and, if it failed, the 'error'. Each one is passed to the
+       hooks, callables that take the measurement, as soon as it is taken.
+
+       The outcome of every layer is counted with add_result. The shard, if
+       the extraction is one, is kept so the reports of all of them can be
+       told apart once they are merged, see merge_reports.
+
+       Unless keep_layers is set, the measurements of a layer are dropped
+       once its outcome is counted, only the `slowest` layers are kept, so
+       the memory used does not grow with the number of layers. The phases
+       of every layer are only written by write when they are kept. Either
+       way only the names of the first `failed` layers that failed are kept.
+    """
+
+    def __init__(self, hooks=None, shard=None, keep_layers=True, slowest=SLOWEST,
+                 failed=FAILED):
+        self.hooks = list(hooks or [])
+        self.shard = shard
+        self.keep_layers = keep_layers
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.layers = {}
+        self.hosts = {}
+        self.results = {}
+        self.failed = []
+        self.failed_size = failed
+        # Heap of (seconds, name, layer) of the slowest layers that were
+        # dropped, and the number of layers dropped in total
+        self.slowest = []
+        self.slowest_size = slowest
+        self.dropped = 0
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def add(self, record):
+        ended = record['started'] + record['seconds']
+        failed = int('error' in record)
+        with self.lock:
+            phase = self.phases.setdefault(record['phase'], {
+                'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+            phase['count'] += 1
+            phase['seconds'] += record['seconds']
+            phase['bytes'] += record['bytes']
+            phase['errors'] += failed
+
+            if record['layer'] is not None:
+                layer = self.layers.setdefault(record['layer'], {
+                    'seconds': 0.0, 'bytes': 0, 'phases': {}})
+                layer['seconds'] += record['seconds']
+                layer['bytes'] += record['bytes']
+                layer_phase = layer['phases'].setdefault(record['phase'], {
+                    'seconds': 0.0, 'bytes': 0})
+                layer_phase['seconds'] += record['seconds']
+                layer_phase['bytes'] += record['bytes']
+
+            if record['host'] is not None:
+                host = self.hosts.setdefault(record['host'], {
+                    'requests': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0,
+                    'first': record['started'], 'last': ended})
+                host['requests'] += 1
+                host['seconds'] += record['seconds']
+                host['bytes'] += record['bytes']
+                host['errors'] += failed
+                host['first'] = min(host['first'], record['started'])
+                host['last'] = max(host['last'], ended)
+
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception, e:
+                log.exception('Report hook "%s" failed' % hook)
+
+    def add_result(self, info):
+        """Counts the outcome of a layer, as returned by extract_layer.
+        """
+        with self.lock:
+            self.results[info['status']] = self.results.get(info['status'], 0) + 1
+            if info['status'] == 'failed' and len(self.failed) < self.failed_size:
+                self.failed.append(info['name'])
+            if self.keep_layers or info['name'] not in self.layers:
+                return
+            layer = self.layers.pop(info['name'])
+            self.dropped += 1
+            heapq.heappush(self.slowest, (layer['seconds'], info['name'], layer))
+            if len(self.slowest) > self.slowest_size:
+                heapq.heappop(self.slowest)
+
+    def summary(self, slowest=SLOWEST):
+        """Returns the totals per phase, the throughput per host, the number
+           of layers per status and the slowest layers, as a dict that can be
+           written as JSON, see summarize.
+        """
+        with self.lock:
+            shards = []
+            if self.shard is not None:
+                shards.append(self.shard)
+            layers = dict(self.layers)
+            for seconds, name, layer in self.slowest:
+                layers[name] = layer
+            summary = summarize(self.phases, layers, self.hosts, self.results,
+                                self.failed, shards, self.started, time.time(),
+                                slowest)
+            summary['layers'] = len(self.layers) + self.dropped
+            return summary
+
+    def write(self, filename, slowest=SLOWEST):
+        """Writes the summary, followed by the phases of every layer, as a
+           JSON document.
+        """
+        report = self.summary(slowest)
+        with self.lock:
+            report['per_layer'] = self.layers
+            write_report(report, filename)
+
+
+def write_report(report, filename):
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def summarize(phases, layers, hosts, results, failed, shards, started,
+              finished, slowest=SLOWEST):
+    """Builds the summary of a report, see Report.summary.
+
+       The 'seconds' of phases and hosts add up the time of every
+       measurement, so they are larger than the wall clock time when layers
+       are extracted concurrently. 'megabytes_per_second' of a host is
+       measured over the wall clock time between its 'first' and 'last'
+       request. 'failed' lists the names of the first layers that failed,
+       'results' has how many did.
+    """
+    hosts = dict((name, dict(host)) for name, host in hosts.items())
+    for host in hosts.values():
+        elapsed = host['last'] - host['first']
+        host['megabytes_per_second'] = None
+        if elapsed > 0:
+            host['megabytes_per_second'] = host['bytes'] / MB / elapsed
+
+    ranked = sorted(layers.items(), key=lambda item: item[1]['seconds'], reverse=True)
+    slowest_layers = []
+    for name, layer in ranked[:slowest]:
+        details = dict(layer)
+        details['layer'] = name
+        slowest_layers.append(details)
+
+    return {'started': started,
+            'finished': finished,
+            'seconds': finished - started,
+            'layers': len(layers),
+            'bytes': sum([p['bytes'] for p in phases.values()]),
+            'phases': dict((k, dict(v)) for k, v in phases.items()),
+            'hosts': hosts,
+            'results': dict(results),
+            'failed': list(failed),
+            'shards': list(shards),
+            'slowest': slowest_layers}
+
+
+def merge_reports(reports, slowest=SLOWEST):
+    """Combines reports written by Report.write, like the ones of every shard
+       of an extraction, into one with the same format. Its 'seconds' go from
+       the start of the first report to the end of the last one.
+    """
+    phases = {}
+    layers = {}
+    hosts = {}
+    results = {}
+    failed = []
+    shards = []
+    for report in reports:
+        for name, phase in report['phases'].items():
+            total = phases.setdefault(name, {
+                'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+            for key in total:
+                total[key] += phase[key]
+        for name, host in report['hosts'].items():
+            total = hosts.setdefault(name, {
+                'requests': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0,
+                'first': host['first'], 'last': host['last']})
+            for key in ['requests', 'seconds', 'bytes', 'errors']:
+                total[key] += host[key]
+            total['first'] = min(total['first'], host['first'])
+            total['last'] = max(total['last'], host['last'])
+        for name, count in report['results'].items():
+            results[name] = results.get(name, 0) + count
+        layers.update(report['per_layer'])
+        failed.extend(report['failed'])
+        shards.extend(report['shards'])
+
+    started = min([report['started'] for report in reports])
+    finished = max([report['finished'] for report in reports])
+    merged = summarize(phases, layers, hosts, results, failed[:FAILED], shards,
+                       started, finished, slowest)
+    merged['per_layer'] = layers
+    return merged
+
+
+class JSONLinesWriter(object):
+    """Report hook that appends every measurement to a file as a line of
+       JSON, so they can be followed while the extraction runs.
+    """
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.file = open(filename, 'a')
+
+    def __call__(self, record):
+        line = json.dumps(record, sort_keys=True)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def load_hook(name):
+    """Imports a report hook given as 'package.module:function'.
+    """
+    module_name, _, function_name = name.partition(':')
+    if not module_name or not function_name:
+        raise RuntimeError('Report hooks are given as "module:function", '
+                           'not "%s"' % name)
+    __import__(module_name)
+    return getattr(sys.modules[module_name], function_name)
+
+
+@contextmanager
+def measure(report, layer, phase, url=None):
+    """Measures the phase of layer that runs inside the with statement, and
+       adds it to report unless that is None. It gives the measurement to the
+       body of the with statement, which sets its 'bytes'.
+    """
+    record = {'layer': layer, 'phase': phase, 'host': None, 'bytes': 0,
+              'started': time.time()}
+    if url is not None:
+        record['host'] = urlparse.urlsplit(url).netloc
+    try:
+        yield record
+    except Exception, e:
+        record['error'] = '%s: %s' % (e.__class__.__name__, e)
+        raise
+    finally:
+        record['seconds'] = time.time() - record['started']
+        if report is not None:
+            report.add(record)
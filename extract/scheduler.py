@@ -0,0 +1,204 @@
+"""Retries and adaptive concurrency, to get the most out of a server without
+   knocking it over.
+
+   Requests that fail because the server is busy, with a 429, 502, 503 or 504
+   status, a timeout or a dropped connection, are retried after a randomized
+   exponential backoff, or after as long as the Retry-After header says.
+
+   The number of layers extracted at the same time follows an additive
+   increase, multiplicative decrease scheme like the one TCP uses for its
+   congestion window: it grows by about one for every round of requests that
+   went well, and halves whenever the server pushes back or slows down.
+"""
+from __future__ import with_statement
+
+import time
+import random
+import logging
+import urlparse
+import threading
+import email.utils
+import requests
+
+log = logging.getLogger("geonode-extract")
+
+# Responses that mean the server is overloaded, and the request can be repeated
+RETRY_STATUSES = [429, 502, 503, 504]
+
+# Seconds before the first retry, doubled for every one after it
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# Servers asking for a longer pause than this are not retried
+MAX_RETRY_AFTER = 300.0
+
+# A request is slow if it takes LATENCY_FACTOR times as long as the fastest
+# one to the same place, and at least MIN_LATENCY_INCREASE seconds more.
+LATENCY_FACTOR = 3.0
+MIN_LATENCY_INCREASE = 0.1
+
+# Decreases closer together than this count as one, because requests sent at
+# the same time tend to fail at the same time.
+COOLDOWN = 1.0
+
+
+def get_retry_after(response):
+    """Seconds the server asked to wait in the Retry-After header of
+       response, given in seconds or as a date, or None.
+    """
+    value = response.headers.get('retry-after')
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(email.utils.mktime_tz(date) - time.time(), 0.0)
+
+
+def get_backoff(attempt, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+    """Seconds to wait before retrying after `attempt` failed attempts.
+
+       The wait is picked at random up to an exponentially growing limit, so
+       requests that failed together do not all come back at the same time.
+    """
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def get_latency_key(url):
+    # Latencies are only comparable between requests of the same kind, like
+    # all the styles or all the downloads of one server.
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    return netloc, path.rsplit('/', 1)[0]
+
+
+class Limiter(object):
+    """Adaptive limit on how many layers are extracted at the same time, up
+       to `maximum`. Used as a context manager around the work of each layer,
+       it blocks until there is room for one more.
+
+       The limit is raised by success and lowered by failure, see
+       RetryingSession. It starts at the maximum, so it only comes down once
+       the server shows it can not keep up.
+    """
+
+    def __init__(self, maximum, minimum=1, decrease=0.5,
+                 latency_factor=LATENCY_FACTOR, cooldown=COOLDOWN):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.baselines = {}
+        self.last_decrease = 0
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, exception_type, error, traceback):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def success(self, url, latency):
+        """Records a request to url that took latency seconds to answer.
+        """
+        key = get_latency_key(url)
+        with self.condition:
+            baseline = self.baselines.get(key)
+            if baseline is None or latency < baseline:
+                self.baselines[key] = baseline = latency
+            if (latency > baseline * self.latency_factor and
+                    latency > baseline + MIN_LATENCY_INCREASE):
+                self.lower('requests to "%s" slowed down to %.2f seconds' % (url, latency))
+                return
+            previous = int(self.limit)
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            if int(self.limit) > previous:
+                self.condition.notify_all()
+
+    def failure(self, url, reason):
+        """Records a request to url that failed because the server is busy.
+        """
+        with self.condition:
+            self.lower('a request to "%s" failed with %s' % (url, reason))
+
+    def lower(self, reason):
+        # Has to be called with the condition held.
+        now = time.time()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        limit = max(self.minimum, self.limit * self.decrease)
+        if int(limit) < int(self.limit):
+            log.info('Extracting %d layers at a time instead of %d, because %s' % (
+                        int(limit), int(self.limit), reason))
+        self.limit = limit
+
+
+class RetryingSession(requests.Session):
+    """Session that retries requests that failed because the server is busy,
+       up to `retries` times, and applies a default timeout in seconds to
+       every request. If a limiter is given, it is told how every request went.
+
+       Only getting the response is retried, errors while reading the body of
+       a streamed response are left to the caller.
+    """
+
+    def __init__(self, retries=0, backoff=BACKOFF, timeout=None, limiter=None):
+        requests.Session.__init__(self)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = limiter
+
+    def request(self, method, url, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                r = requests.Session.request(self, method, url, **kwargs)
+            except (requests.exceptions.Timeout,
+                    requests.exceptions.ConnectionError), e:
+                r = None
+                reason = e.__class__.__name__
+                if attempt >= self.retries:
+                    if self.limiter is not None:
+                        self.limiter.failure(url, reason)
+                    raise
+            else:
+                if r.status_code not in RETRY_STATUSES:
+                    if self.limiter is not None:
+                        self.limiter.success(url, time.time() - started)
+                    return r
+                reason = 'status %d' % r.status_code
+
+            if self.limiter is not None:
+                self.limiter.failure(url, reason)
+
+            delay = get_backoff(attempt, self.backoff)
+            if r is not None:
+                retry_after = get_retry_after(r)
+                if retry_after is not None:
+                    delay = retry_after
+                if attempt >= self.retries or delay > MAX_RETRY_AFTER:
+                    return r
+                r.close()
+
+            attempt += 1
+            log.warning('Request to "%s" failed with %s, retrying in %.1f seconds '
+                        '(%d of %d)' % (url, reason, delay, attempt, self.retries))
+            time.sleep(delay)
@@ -0,0 +1,142 @@
+"""Content addressed storage of the extracted files.
+
+   Layers often share the same style, and layers that were published more
+   than once have identical data. With a BlobStore every file is kept once in
+   the .blobs directory of the destination, named after its SHA-256 digest,
+   and the files of the layers are hard links to it.
+"""
+from __future__ import with_statement
+
+import os
+import errno
+import hashlib
+import logging
+import threading
+
+log = logging.getLogger("geonode-extract")
+
+BLOBS_DIRNAME = '.blobs'
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_digest(filename, chunk_size=CHUNK_SIZE):
+    """SHA-256 digest of the contents of filename, as a hex string.
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class HashingWriter(object):
+    """Writes to a file object and computes the SHA-256 digest and the size
+       of what was written along the way, so files do not have to be read
+       again to be checked or added to a BlobStore.
+    """
+
+    def __init__(self, out):
+        self.out = out
+        self.name = getattr(out, 'name', None)
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        self.out.write(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def close(self):
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, error, traceback):
+        self.close()
+
+
+class BlobStore(object):
+    """Keeps one copy of every distinct file written to dest_dir.
+
+       Files are added once they are complete and in place. The first file
+       with a given digest becomes the blob, later ones are replaced by hard
+       links to it. It is safe to share between threads, and between hosts
+       writing to the same destination.
+
+       Files in the store must never be written in place, because that would
+       change every layer that links to them. Write a new file and rename it
+       over the old one instead.
+    """
+
+    def __init__(self, dest_dir):
+        self.path = os.path.join(dest_dir, BLOBS_DIRNAME)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.lock = threading.Lock()
+        self.duplicates = 0
+        self.saved = 0
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def add(self, filename, digest=None):
+        """Adds filename to the store, computing its digest unless it is given.
+           Returns the digest.
+        """
+        if digest is None:
+            digest = get_digest(filename)
+        blob = self.get_blob_path(digest)
+        blob_dir = os.path.dirname(blob)
+        if not os.path.isdir(blob_dir):
+            try:
+                os.makedirs(blob_dir)
+            except OSError, e:
+                # Another thread got there first
+                if e.errno != errno.EEXIST:
+                    raise
+
+        try:
+            os.link(filename, blob)
+            return digest
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        if os.path.samefile(filename, blob):
+            return digest
+
+        # Replace the file with a link to the blob, without a moment in
+        # which the file is missing.
+        link = filename + '.link'
+        if os.path.exists(link):
+            os.remove(link)
+        os.link(blob, link)
+        size = os.path.getsize(filename)
+        os.rename(link, filename)
+        log.debug('"%s" is identical to "%s", linked it' % (filename, blob))
+        with self.lock:
+            self.duplicates += 1
+            self.saved += size
+        return digest
+
+    def prune(self):
+        """Removes the blobs no file links to anymore, like the old versions
+           of files that changed. Returns the number of bytes freed.
+        """
+        freed = 0
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                blob = os.path.join(dirpath, name)
+                info = os.stat(blob)
+                if info.st_nlink == 1:
+                    os.remove(blob)
+                    freed += info.st_size
+        return freed
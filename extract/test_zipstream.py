@@ -0,0 +1,141 @@
+"""Tests for extract.zipstream, run with python -m unittest extract.test_zipstream
+"""
+from __future__ import with_statement
+
+import os
+import zlib
+import shutil
+import struct
+import zipfile
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from extract import zipstream
+
+MEMBERS = [('roads.shp', 'shape' * 1000),
+           ('roads.dbf', ''.join([chr(i % 256) for i in range(5000)])),
+           ('roads.prj', 'GEOGCS["WGS 84"]')]
+
+
+def make_zip(compression):
+    """A zip archive of MEMBERS, with a directory in front, written by the
+       zipfile module.
+    """
+    out = StringIO()
+    archive = zipfile.ZipFile(out, 'w', compression)
+    archive.writestr('roads/', '')
+    for name, data in MEMBERS:
+        archive.writestr(name, data)
+    archive.close()
+    return out.getvalue()
+
+
+def make_streamed_zip():
+    """A deflated zip archive of MEMBERS like the ones written to a stream,
+       with the sizes and CRC in data descriptors after the data of every
+       member. Only the end of central directory record follows, unpack does
+       not read any further.
+    """
+    parts = []
+    for name, data in MEMBERS:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS)
+        compressed = compressor.compress(data) + compressor.flush()
+        parts.append(zipstream.LOCAL_HEADER)
+        parts.append(struct.pack('<HHHHHIIIHH', 20, 0x08, zipstream.DEFLATED,
+                                 0, 0, 0, 0, 0, len(name), 0))
+        parts.append(name)
+        parts.append(compressed)
+        parts.append(zipstream.DATA_DESCRIPTOR)
+        parts.append(struct.pack('<III', zlib.crc32(data) & 0xFFFFFFFF,
+                                 len(compressed), len(data)))
+    parts.append(zipstream.END_OF_CENTRAL_DIRECTORY + '\0' * 18)
+    return ''.join(parts)
+
+
+def split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+class UnpackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dest_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dest_dir)
+
+    def get_filename(self, name):
+        return os.path.join(self.dest_dir, name)
+
+    def check_unpack(self, body, chunk_size):
+        filenames = zipstream.unpack(split(body, chunk_size), self.get_filename)
+        self.assertEqual(filenames, [self.get_filename(name) for name, _ in MEMBERS])
+        for name, data in MEMBERS:
+            with open(self.get_filename(name), 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_stored(self):
+        body = make_zip(zipfile.ZIP_STORED)
+        self.check_unpack(body, len(body))
+        self.check_unpack(body, 1)
+
+    def test_deflated(self):
+        body = make_zip(zipfile.ZIP_DEFLATED)
+        self.check_unpack(body, len(body))
+        self.check_unpack(body, 1)
+
+    def test_data_descriptors(self):
+        body = make_streamed_zip()
+        self.check_unpack(body, len(body))
+        self.check_unpack(body, 1)
+
+    def test_central_directory_is_left_unread(self):
+        # Callers that check the size of the download have to read the rest
+        body = make_zip(zipfile.ZIP_STORED)
+        chunks = iter(split(body, 1))
+        zipstream.unpack(chunks, self.get_filename)
+        self.assertTrue(len(''.join(chunks)) > 0)
+
+    def test_bad_crc(self):
+        body = make_streamed_zip()
+        # Flips a byte of the CRC in the first data descriptor
+        position = body.index(zipstream.DATA_DESCRIPTOR) + 4
+        body = body[:position] + chr(ord(body[position]) ^ 0xFF) + body[position + 1:]
+        self.assertRaises(zipfile.BadZipfile, zipstream.unpack, [body],
+                          self.get_filename)
+
+    def test_skipped_members(self):
+        def get_filename(name):
+            if name.endswith('.shp'):
+                return self.get_filename(name)
+            return None
+        body = make_zip(zipfile.ZIP_DEFLATED)
+        filenames = zipstream.unpack(split(body, 7), get_filename)
+        self.assertEqual(filenames, [self.get_filename('roads.shp')])
+        self.assertEqual(os.listdir(self.dest_dir), ['roads.shp'])
+
+
+class CountMembersTest(unittest.TestCase):
+
+    def test_count(self):
+        body = make_zip(zipfile.ZIP_DEFLATED)
+        self.assertEqual(zipstream.count_members(body[-100:]), len(MEMBERS) + 1)
+
+    def test_zip64(self):
+        # Zip64 record with 70000 members, its locator, and an end of
+        # central directory record that leaves the count to them
+        tail = (zipstream.ZIP64_END_OF_CENTRAL_DIRECTORY +
+                struct.pack('<QHHIIQQQQ', 44, 45, 45, 0, 0, 70000, 70000, 0, 0) +
+                'PK\x06\x07' + '\0' * 16 +
+                zipstream.END_OF_CENTRAL_DIRECTORY +
+                struct.pack('<HHHHIIH', 0, 0, 0xFFFF, 0xFFFF, 0xFFFFFFFF, 0xFFFFFFFF, 0))
+        self.assertEqual(zipstream.count_members(tail), 70000)
+
+    def test_no_end_record(self):
+        self.assertEqual(zipstream.count_members('not a zip archive'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
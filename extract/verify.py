@@ -0,0 +1,155 @@
+"""Checks an extraction against the SHA-256 digests and sizes recorded while
+   its files were written, without connecting to the server.
+
+   Files are hashed concurrently. hashlib lets go of the interpreter lock
+   while it hashes, so the threads use as many cores as there are.
+"""
+from __future__ import with_statement
+
+import os
+import glob
+import hashlib
+import logging
+import threading
+import multiprocessing
+
+from extract.archive import ArchiveReader
+from extract.manifest import MANIFEST_FILENAME, Manifest
+from extract.planner import run_concurrently
+from extract.store import get_digest
+
+log = logging.getLogger("geonode-extract")
+
+CHUNK_SIZE = 1024 * 1024
+
+# Outcomes of checking a file
+OK = 'ok'
+MISSING = 'missing'
+CHANGED = 'changed'
+UNRECORDED = 'unrecorded'
+
+
+def get_concurrency(workers=None):
+    if workers is None or workers <= 1:
+        return multiprocessing.cpu_count()
+    return workers
+
+
+def get_manifests(dest_dir):
+    """Returns the paths of the manifests in dest_dir, the one of a whole
+       extraction and the ones of its shards.
+    """
+    base, extension = os.path.splitext(MANIFEST_FILENAME)
+    return sorted(glob.glob(os.path.join(dest_dir, base + '*' + extension)))
+
+
+def get_range_digest(filename, start, size, chunk_size=CHUNK_SIZE):
+    """SHA-256 digest of size bytes of filename from start on, and the number
+       of bytes that could be read.
+    """
+    digest = hashlib.sha256()
+    read = 0
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        while read < size:
+            data = f.read(min(chunk_size, size - read))
+            if not data:
+                break
+            digest.update(data)
+            read += len(data)
+    return digest.hexdigest(), read
+
+
+def check_file(filename, expected):
+    """Compares filename with the dict expected, with its 'sha256' digest and
+       'size', and returns the status and a description of the problem, if
+       there is one.
+    """
+    if expected is None:
+        return UNRECORDED, 'no digest was recorded'
+    if not os.path.exists(filename):
+        return MISSING, 'the file is missing'
+    size = os.path.getsize(filename)
+    if size != expected['size']:
+        return CHANGED, 'it has %d bytes instead of %d' % (size, expected['size'])
+    if get_digest(filename, CHUNK_SIZE) != expected['sha256']:
+        return CHANGED, 'its digest does not match'
+    return OK, None
+
+
+def verify(checks, workers=None):
+    """Runs check(), for every check in checks, from `workers` threads, one
+       per core by default. Each returns a dict with the 'layer', the 'file',
+       the 'status' and the 'problem', if any. Returns the list of those.
+    """
+    results = []
+    lock = threading.Lock()
+
+    def run(check):
+        result = check()
+        if result['status'] != OK:
+            log.debug('"%s" of "%s": %s' % (result['file'], result['layer'],
+                                            result['problem']))
+        with lock:
+            results.append(result)
+
+    run_concurrently(run, checks, get_concurrency(workers))
+    results.sort(key=lambda result: (result['layer'], result['file']))
+    return results
+
+
+def verify_directory(dest_dir, workers=None):
+    """Checks every file the manifests in dest_dir have as completely written,
+       see verify.
+    """
+    checks = []
+    for filename in get_manifests(dest_dir):
+        manifest = Manifest(dest_dir, os.path.basename(filename))
+        try:
+            records = list(manifest.records())
+        finally:
+            manifest.close()
+        for record in records:
+            for name in record['files']:
+                checks.append(make_file_check(dest_dir, record['layer'], name,
+                                              record['digests'].get(name)))
+    return verify(checks, workers)
+
+
+def make_file_check(dest_dir, layer, name, expected):
+    def check():
+        status, problem = check_file(os.path.join(dest_dir, name), expected)
+        return {'layer': layer, 'file': name, 'status': status, 'problem': problem}
+    return check
+
+
+def verify_archive(filename, workers=None):
+    """Checks every file of every layer in an archive written with
+       archive.LayerArchive against its index, see verify.
+    """
+    reader = ArchiveReader(filename)
+    try:
+        checks = []
+        for layer in reader.layers():
+            for member in reader.members(layer):
+                checks.append(make_member_check(filename, layer, member))
+    finally:
+        reader.close()
+    return verify(checks, workers)
+
+
+def make_member_check(filename, layer, member):
+    def check():
+        result = {'layer': layer, 'file': member['name'], 'status': OK, 'problem': None}
+        if member['sha256'] is None:
+            result['status'], result['problem'] = UNRECORDED, 'no digest was recorded'
+            return result
+        digest, read = get_range_digest(filename, member['start'], member['size'])
+        if read != member['size']:
+            result['status'] = MISSING
+            result['problem'] = 'the archive ends after %d of its %d bytes' % (
+                                    read, member['size'])
+        elif digest != member['sha256']:
+            result['status'], result['problem'] = CHANGED, 'its digest does not match'
+        return result
+    return check
@@ -0,0 +1,300 @@
+"""Rewrites XML documents while they are being downloaded.
+
+   The documents are read with an incremental SAX parser and written out as
+   soon as every element starts or ends, so they never have to be held in
+   memory as a DOM tree.
+"""
+import xml.sax
+from xml.sax import handler
+from xml.sax.saxutils import escape, quoteattr
+
+CSW_ENVELOPE = 'csw:GetRecordByIdResponse'
+SEARCH_RESULTS = 'csw:SearchResults'
+FILE_IDENTIFIER = 'gmd:fileIdentifier'
+
+INDENT = '\t'
+
+
+class XMLWriter(handler.ContentHandler):
+    """SAX handler that writes the document it receives to out.
+
+       If the root element is named `unwrap` it is left out, and the first
+       element inside it becomes the root of the document. Any namespace
+       declarations of the dropped element are moved to the new root.
+
+       With pretty, whitespace between elements is replaced by newlines and
+       indentation and the text of every element is stripped. Otherwise the
+       text is written unchanged.
+    """
+
+    def __init__(self, out, unwrap=None, pretty=True, encoding='utf-8'):
+        handler.ContentHandler.__init__(self)
+        self.out = out
+        self.unwrap = unwrap
+        self.pretty = pretty
+        self.encoding = encoding
+
+        self.depth = 0
+        # Depth of the element that is the root of the output
+        self.root_depth = 1
+        self.namespaces = {}
+        self.done = False
+
+        # Whether the current start tag still has to be closed with '>'
+        self.open_tag = False
+        # Whether the current element has child elements, one per level
+        self.has_children = []
+        self.text = []
+
+    def write(self, data):
+        self.out.write(data.encode(self.encoding))
+
+    def is_written(self):
+        return self.depth >= self.root_depth and not self.done
+
+    def close_tag(self):
+        if self.open_tag:
+            self.write('>')
+            self.open_tag = False
+
+    def flush_text(self):
+        text = ''.join(self.text)
+        self.text = []
+        if self.pretty:
+            text = text.strip()
+            if text and self.has_children and self.has_children[-1]:
+                self.write('\n' + INDENT * len(self.has_children))
+        if text:
+            self.close_tag()
+            self.write(escape(text))
+
+    def startDocument(self):
+        self.write(u'<?xml version="1.0" encoding="%s"?>\n' % self.encoding)
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        if self.depth == 1 and name == self.unwrap:
+            self.root_depth = 2
+            for attr, value in attrs.items():
+                if attr == 'xmlns' or attr.startswith('xmlns:'):
+                    self.namespaces[attr] = value
+            return
+        if not self.is_written():
+            return
+
+        attrs = dict(attrs.items())
+        if self.depth == self.root_depth:
+            for attr, value in self.namespaces.items():
+                attrs.setdefault(attr, value)
+
+        self.flush_text()
+        self.close_tag()
+        if self.has_children:
+            self.has_children[-1] = True
+        if self.pretty and self.has_children:
+            self.write('\n' + INDENT * len(self.has_children))
+
+        self.write('<' + name)
+        for attr, value in sorted(attrs.items()):
+            self.write(' %s=%s' % (attr, quoteattr(value)))
+        self.open_tag = True
+        self.has_children.append(False)
+
+    def endElement(self, name):
+        if self.is_written():
+            self.flush_text()
+            had_children = self.has_children.pop()
+            if self.open_tag:
+                self.write('/>')
+                self.open_tag = False
+            else:
+                if self.pretty and had_children:
+                    self.write('\n' + INDENT * len(self.has_children))
+                self.write('</%s>' % name)
+            if self.depth == self.root_depth:
+                # Only the first element inside an envelope is kept
+                self.done = True
+                if self.pretty:
+                    self.write('\n')
+        self.depth -= 1
+
+    def characters(self, content):
+        if self.is_written():
+            self.text.append(content)
+
+    def ignorableWhitespace(self, content):
+        self.characters(content)
+
+    def processingInstruction(self, target, data):
+        if self.is_written():
+            self.flush_text()
+            self.close_tag()
+            self.write('<?%s %s?>' % (target, data))
+
+    # Lexical events, expat only reports comments and CDATA boundaries
+
+    def comment(self, content):
+        if self.is_written() or self.depth == 0:
+            self.flush_text()
+            self.close_tag()
+            if self.pretty and self.has_children:
+                self.write('\n' + INDENT * len(self.has_children))
+            self.write('<!--%s-->' % content)
+            if self.pretty and not self.has_children:
+                self.write('\n')
+
+    def startCDATA(self):
+        pass
+
+    def endCDATA(self):
+        pass
+
+    def startDTD(self, name, public_id, system_id):
+        pass
+
+    def endDTD(self):
+        pass
+
+    def startEntity(self, name):
+        pass
+
+    def endEntity(self, name):
+        pass
+
+
+def get_parser(content_handler):
+    parser = xml.sax.make_parser()
+    parser.setFeature(handler.feature_namespaces, False)
+    # Never fetch external DTDs or entities mentioned in downloaded documents
+    parser.setFeature(handler.feature_external_ges, False)
+    parser.setFeature(handler.feature_external_pes, False)
+    parser.setContentHandler(content_handler)
+    parser.setProperty(handler.property_lexical_handler, content_handler)
+    return parser
+
+
+def write_xml(chunks, out, unwrap=None, pretty=True):
+    """Parses the XML document in chunks, an iterable of byte strings, and
+       writes it to the file object out as it goes, see XMLWriter.
+
+       Raises xml.sax.SAXParseException if the document is not well formed.
+    """
+    parser = get_parser(XMLWriter(out, unwrap, pretty))
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+
+
+class RecordSplitter(handler.ContentHandler):
+    """SAX handler that splits the records of a CSW GetRecords response.
+
+       Every element inside csw:SearchResults is written as a document of its
+       own with an XMLWriter, to the file object returned by open_record().
+       Once a record ends, finish_record(out, identifier) is called with that
+       file object and the text of the gmd:fileIdentifier of the record.
+
+       The attributes of csw:SearchResults, like nextRecord, are available in
+       search_results once the parser is past it.
+    """
+
+    def __init__(self, open_record, finish_record, pretty=True):
+        handler.ContentHandler.__init__(self)
+        self.open_record = open_record
+        self.finish_record = finish_record
+        self.pretty = pretty
+
+        self.depth = 0
+        self.namespaces = {}
+        self.search_results = {}
+        self.results_depth = None
+
+        self.writer = None
+        self.out = None
+        self.identifier = None
+        self.in_identifier = False
+
+    def startElement(self, name, attrs):
+        self.depth += 1
+        if self.depth == 1:
+            for attr, value in attrs.items():
+                if attr == 'xmlns' or attr.startswith('xmlns:'):
+                    self.namespaces[attr] = value
+        if name == SEARCH_RESULTS and self.results_depth is None:
+            self.results_depth = self.depth
+            self.search_results = dict(attrs.items())
+            return
+
+        if self.writer is None and self.depth == (self.results_depth or -1) + 1:
+            self.out = self.open_record()
+            self.writer = XMLWriter(self.out, pretty=self.pretty)
+            self.writer.namespaces = dict(self.namespaces)
+            self.writer.startDocument()
+            self.identifier = []
+
+        if self.writer is not None:
+            if name == FILE_IDENTIFIER and self.identifier == []:
+                self.in_identifier = True
+            self.writer.startElement(name, attrs)
+
+    def endElement(self, name):
+        if self.writer is not None:
+            self.writer.endElement(name)
+            if name == FILE_IDENTIFIER:
+                self.in_identifier = False
+            if self.depth == self.results_depth + 1:
+                self.writer.endDocument()
+                identifier = ''.join(self.identifier).strip()
+                self.finish_record(self.out, identifier)
+                self.writer = None
+                self.out = None
+        self.depth -= 1
+
+    def characters(self, content):
+        if self.writer is not None:
+            if self.in_identifier:
+                self.identifier.append(content)
+            self.writer.characters(content)
+
+    def ignorableWhitespace(self, content):
+        self.characters(content)
+
+    def processingInstruction(self, target, data):
+        if self.writer is not None:
+            self.writer.processingInstruction(target, data)
+
+    def comment(self, content):
+        if self.writer is not None:
+            self.writer.comment(content)
+
+    def startCDATA(self):
+        pass
+
+    def endCDATA(self):
+        pass
+
+    def startDTD(self, name, public_id, system_id):
+        pass
+
+    def endDTD(self):
+        pass
+
+    def startEntity(self, name):
+        pass
+
+    def endEntity(self, name):
+        pass
+
+
+def split_records(chunks, open_record, finish_record, pretty=True):
+    """Parses the CSW GetRecords response in chunks, an iterable of byte
+       strings, and writes each record it contains on its own as it goes,
+       see RecordSplitter.
+
+       Returns the attributes of csw:SearchResults.
+    """
+    splitter = RecordSplitter(open_record, finish_record, pretty)
+    parser = get_parser(splitter)
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+    return splitter.search_results
@@ -0,0 +1,218 @@
+"""Unpacks zip archives while they are being downloaded.
+
+   The zipfile module needs the whole archive in a seekable file, because it
+   reads the central directory at the end first. The members of an archive
+   are also preceded by local headers with everything needed to extract them,
+   so reading those in order is enough to unpack it from a stream.
+"""
+import zlib
+import struct
+import zipfile
+
+LOCAL_HEADER = 'PK\x03\x04'
+DATA_DESCRIPTOR = 'PK\x07\x08'
+# Once any of these shows up there are no more members to extract
+END_SIGNATURES = ['PK\x01\x02', 'PK\x05\x05', 'PK\x06\x06', 'PK\x06\x07',
+                  'PK\x06\x08', 'PK\x05\x06']
+
+ZIP64_EXTRA = 0x0001
+END_OF_CENTRAL_DIRECTORY = 'PK\x05\x06'
+ZIP64_END_OF_CENTRAL_DIRECTORY = 'PK\x06\x06'
+STORED = 0
+DEFLATED = 8
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ChunkReader(object):
+    """File-like reading on top of an iterable of byte strings.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size):
+        """Returns exactly size bytes, or less if the stream ends before.
+        """
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while length < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = ''.join(parts)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def read_some(self, size):
+        """Returns up to size bytes without waiting for more than one chunk.
+           An empty string means the stream has ended.
+        """
+        while not self.buffer:
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                return ''
+        data = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return data
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+
+
+def get_zip64_sizes(extra):
+    """Returns the (uncompressed, compressed) sizes in the zip64 extra field
+       of a local header, or None if there is none.
+    """
+    while len(extra) >= 4:
+        header_id, length = struct.unpack('<HH', extra[:4])
+        if header_id == ZIP64_EXTRA and length >= 16:
+            return struct.unpack('<QQ', extra[4:20])
+        extra = extra[4 + length:]
+    return None
+
+
+def unpack(chunks, get_filename, chunk_size=CHUNK_SIZE, open_file=None):
+    """Extracts the members of the zip archive in chunks, an iterable of
+       byte strings, as they are read.
+
+       get_filename is called with the name of every member and returns the
+       path it should be written to, or None to skip it. Directories are
+       always skipped. Returns the list of paths that were written.
+
+       open_file(path) returns the file object a member is written to, by
+       default the path is opened for writing in binary mode.
+
+       Raises zipfile.BadZipfile if the archive is broken or a member does not
+       match its CRC, and RuntimeError for encrypted members or compression
+       methods other than stored and deflated.
+    """
+    reader = ChunkReader(chunks)
+    filenames = []
+
+    while True:
+        signature = reader.read(4)
+        if signature == '' or signature in END_SIGNATURES:
+            break
+        if signature != LOCAL_HEADER:
+            raise zipfile.BadZipfile('Bad magic number for file header')
+
+        header = reader.read(26)
+        if len(header) != 26:
+            raise zipfile.BadZipfile('Truncated file header')
+        (version, flags, method, mtime, mdate, crc, compressed_size, size,
+         name_length, extra_length) = struct.unpack('<HHHHHIIIHH', header)
+        name = reader.read(name_length)
+        extra = reader.read(extra_length)
+
+        zip64_sizes = get_zip64_sizes(extra)
+        zip64 = zip64_sizes is not None
+        if zip64:
+            size, compressed_size = zip64_sizes
+        elif compressed_size == 0xFFFFFFFF or size == 0xFFFFFFFF:
+            raise zipfile.BadZipfile('Missing zip64 sizes for "%s"' % name)
+
+        # The sizes and CRC come after the data when bit 3 is set
+        has_descriptor = flags & 0x08
+
+        if flags & 0x01:
+            raise RuntimeError('File "%s" in the archive is encrypted' % name)
+        if method not in (STORED, DEFLATED):
+            raise RuntimeError('Compression method %d of "%s" is not supported' %
+                               (method, name))
+        if method == STORED and has_descriptor:
+            raise RuntimeError('Can not find the end of "%s" in the archive' % name)
+
+        filename = None
+        if not name.endswith('/'):
+            filename = get_filename(name)
+        out = None
+        if filename is not None:
+            if open_file is None:
+                out = open(filename, 'wb')
+            else:
+                out = open_file(filename)
+
+        written = 0
+        checksum = 0
+        try:
+            if method == DEFLATED:
+                decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            remaining = compressed_size
+            finished = False
+            while not finished:
+                if has_descriptor:
+                    # Only the deflate stream itself knows where it ends
+                    data = reader.read_some(chunk_size)
+                elif remaining > 0:
+                    data = reader.read_some(min(remaining, chunk_size))
+                else:
+                    break
+                if not data:
+                    raise zipfile.BadZipfile('Truncated data for "%s"' % name)
+                remaining -= len(data)
+
+                if method == DEFLATED:
+                    data = decompressor.decompress(data)
+                    if decompressor.unused_data:
+                        # The deflate stream of this member has ended
+                        reader.unread(decompressor.unused_data)
+                        finished = True
+
+                if data:
+                    checksum = zlib.crc32(data, checksum)
+                    written += len(data)
+                    if out is not None:
+                        out.write(data)
+
+            if method == DEFLATED:
+                data = decompressor.flush()
+                if data:
+                    checksum = zlib.crc32(data, checksum)
+                    written += len(data)
+                    if out is not None:
+                        out.write(data)
+        finally:
+            if out is not None:
+                out.close()
+
+        if has_descriptor:
+            descriptor = reader.read(4)
+            if descriptor != DATA_DESCRIPTOR:
+                # The signature of the descriptor is optional
+                reader.unread(descriptor)
+            if zip64:
+                crc, compressed_size, size = struct.unpack('<IQQ', reader.read(20))
+            else:
+                crc, compressed_size, size = struct.unpack('<III', reader.read(12))
+
+        if checksum & 0xFFFFFFFF != crc or written != size:
+            raise zipfile.BadZipfile('Bad CRC-32 for file "%s"' % name)
+
+        if filename is not None:
+            filenames.append(filename)
+
+    return filenames
+
+
+def count_members(tail):
+    """Returns the number of members of a zip archive, directories included,
+       from the last bytes of it, or None if they do not hold the end of
+       central directory record.
+    """
+    position = tail.rfind(END_OF_CENTRAL_DIRECTORY)
+    if position < 0 or len(tail) < position + 22:
+        return None
+    count = struct.unpack('<H', tail[position + 10:position + 12])[0]
+    if count != 0xFFFF:
+        return count
+    # Archives with more members keep the count in the zip64 record
+    position = tail.rfind(ZIP64_END_OF_CENTRAL_DIRECTORY, 0, position)
+    if position < 0 or len(tail) < position + 40:
+        return None
+    return struct.unpack('<Q', tail[position + 32:position + 40])[0]
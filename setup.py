@@ -105,6 +105,7 @@ setup(name          = 'geonode-extract',
       scripts = ['scripts/geonode-extract',],
 #      data_files = [('/usr/share/man/man1', ['geonode-extract.1']),],
       install_requires = ['requests',],
+      extras_require = {'gevent': ['gevent',]},
       cmdclass=cmdclass,
       classifiers   = [
         'Development Status :: 4 - Beta',